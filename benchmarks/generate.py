@@ -0,0 +1,61 @@
+"""Generates synthetic vasara sites for benchmarking."""
+
+import argparse
+import json
+import os
+import random
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut "
+         "labore et dolore magna aliqua garden gnome hammer static site generator").split()
+
+EXTENSIONS = ("html", "md", "txt")
+
+def generate_site(path, items=1000, metadata=4, depth=2, fanout=10, paragraphs=5, seed=0):
+    """Generates a site with the specified number of items in ``path/items``.
+
+    :param path: the site's base path
+    :param items: the number of items
+    :param metadata: the number of metadata fields in each item's front matter
+    :param depth: the depth of the directory tree
+    :param fanout: the number of subdirectories in each directory
+    :param paragraphs: the number of paragraphs in each item's body
+    :param seed: random seed; the same arguments always generate the same site
+    :returns: absolute path to the items directory"""
+    rng = random.Random(seed)
+    items_path = os.path.abspath(os.path.join(path, "items"))
+
+    for number in range(items):
+        directories = []
+        value = number
+        for level in range(depth):
+            directories.append("dir{}".format(value % fanout))
+            value //= fanout
+        directory = os.path.join(items_path, *directories)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        fields = dict(("field{}".format(field), " ".join(rng.sample(WORDS, 3))) for field in range(metadata))
+        fields["title"] = "Item {}".format(number)
+        fields["tags"] = rng.sample(("python", "static", "gnomes", "hammers", "news"), 2)
+        body = "\n\n".join(" ".join(rng.choice(WORDS) for word in range(60)) for paragraph in range(paragraphs))
+
+        name = "item{}.{}".format(number, EXTENSIONS[number % len(EXTENSIONS)])
+        with open(os.path.join(directory, name), "wb") as file:
+            file.write("---\n{}\n---\n\n{}\n".format(json.dumps(fields, indent=4, sort_keys=True), body))
+    return items_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates a synthetic vasara site.")
+    parser.add_argument("path")
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--metadata", type=int, default=4)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--fanout", type=int, default=10)
+    parser.add_argument("--paragraphs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate_site(args.path, items=args.items, metadata=args.metadata, depth=args.depth,
+                  fanout=args.fanout, paragraphs=args.paragraphs, seed=args.seed)
+
+if __name__ == "__main__":
+    main()
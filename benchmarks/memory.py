@@ -0,0 +1,68 @@
+"""Measures the memory used by each item of a site after scanning, applying rules and filtering.
+
+Every size is measured in its own process::
+
+    python -m benchmarks.memory --sizes 10000,100000
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from benchmarks.generate import generate_site
+from benchmarks.run import integers, peak_rss, register_rules
+
+STATES = ("scan", "rules", "filter")
+
+def upper_filter(item):
+    item.filtered_content = item.filtered_content.upper()
+
+def measure(path, rules, queue):
+    # Runs in a child process. Peak memory only grows here, so the differences between the peaks
+    # are the memory used by each step.
+    from vasara import Site
+
+    start = peak_rss()
+    result = {}
+    site = Site(base_path=path, items_path=os.path.join(path, "items"))
+    # The items path is only scanned when the items are first used
+    site.items
+    result["scan"] = peak_rss() - start
+
+    register_rules(site, rules)
+    site.filter(r".*", upper_filter)
+    result["rules"] = peak_rss() - start
+
+    for item in site.items.itervalues():
+        item.content
+    result["filter"] = peak_rss() - start
+
+    queue.put(dict((state, float(size) / len(site.items)) for state, size in result.iteritems()))
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the memory used by each item.")
+    parser.add_argument("--sizes", type=integers, default=[10000, 100000], help="comma separated item counts")
+    parser.add_argument("--metadata", type=int, default=4, help="metadata field count")
+    parser.add_argument("--rules", type=int, default=30, help="rule count")
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp()
+    try:
+        print "{:>7} {:>14} {:>14} {:>14}".format("items", "scan (B/item)", "rules (B/item)", "filter (B/item)")
+        for items in args.sizes:
+            path = os.path.join(base, str(items))
+            generate_site(path, items=items, metadata=args.metadata, paragraphs=1)
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=measure, args=(path, args.rules, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            print "{:>7} {:>14.0f} {:>14.0f} {:>14.0f}".format(items, *[result[state] for state in STATES])
+            shutil.rmtree(path)
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Measures how scanning, rule matching and compilation scale with the size of a site.
+
+Every configuration runs in its own process so that peak memory usage can be measured separately.
+Results can be saved and compared with the results of another commit::
+
+    python -m benchmarks.run --sizes 1000,10000 --output before.json
+    (apply changes)
+    python -m benchmarks.run --sizes 1000,10000 --output after.json --compare before.json
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.generate import EXTENSIONS, generate_site
+
+PHASES = ("scan", "match", "compile")
+
+def noop_filter(item):
+    pass
+
+def templater(item):
+    return u"<html><title>{}</title><body>{}</body></html>".format(item.metadata.get("title", ""), item.content)
+
+def register_rules(site, count):
+    """Registers ``count`` rules with a mix of prefix, extension and general expressions."""
+    site.route(r"(.*)\.[a-z]+$", lambda match, item: "{}/index.html".format(match.group(1)))
+    for number in range(count):
+        kind = number % 3
+        if kind == 0:
+            site.filter(r"dir{}/".format(number % 10), noop_filter)
+        elif kind == 1:
+            site.template(r".*\.{}$".format(EXTENSIONS[number % len(EXTENSIONS)]), templater)
+        else:
+            site.filter(r"(.*)/item{}\d*\.".format(number), noop_filter)
+
+def peak_rss():
+    """Returns the peak resident set size of the current process in bytes."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes
+    return usage if sys.platform == "darwin" else usage * 1024
+
+def measure(path, rules, backend, queue):
+    # Runs in a child process.
+    from vasara import Compiler, Site
+
+    result = {}
+    start = time.time()
+    site = Site(base_path=path, items_path=os.path.join(path, "items"))
+    # The items path is only scanned when the items are first used
+    site.items
+    result["scan"] = time.time() - start
+
+    start = time.time()
+    register_rules(site, rules)
+    result["match"] = time.time() - start
+
+    output = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        Compiler(site=site, output_path=output, backend=backend).compile()
+        result["compile"] = time.time() - start
+    finally:
+        shutil.rmtree(output)
+
+    result["peak_rss"] = peak_rss()
+    queue.put(result)
+
+def run_configuration(path, rules, backend):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(path, rules, backend, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def commit():
+    """Returns the current git commit or ``None``."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    """Prints each phase's time relative to a baseline run with the same configuration."""
+    def configuration(result):
+        return tuple(result[key] for key in ("items", "metadata", "depth", "rules", "backend"))
+
+    previous = dict((configuration(result), result) for result in baseline["results"])
+    print
+    print "Compared with {}:".format(baseline.get("commit") or "baseline")
+    for result in results:
+        old = previous.get(configuration(result))
+        if old is None:
+            continue
+        changes = ["{} {:+.1%}".format(phase, float(result[phase]) / old[phase] - 1) for phase in PHASES + ("peak_rss",)
+                   if old.get(phase)]
+        print "  {:>7} items, {:>3} fields, depth {}, {:>3} rules: {}".format(
+            result["items"], result["metadata"], result["depth"], result["rules"], ", ".join(changes))
+
+def integers(value):
+    return [int(part) for part in value.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks vasara with synthetic sites.")
+    parser.add_argument("--sizes", type=integers, default=[1000, 10000, 100000], help="comma separated item counts")
+    parser.add_argument("--metadata", type=integers, default=[4], help="comma separated metadata field counts")
+    parser.add_argument("--depth", type=integers, default=[2], help="comma separated directory depths")
+    parser.add_argument("--rules", type=integers, default=[10], help="comma separated rule counts")
+    parser.add_argument("--backend", default="serial", help="compiler backend")
+    parser.add_argument("--output", help="write the results to a JSON file")
+    parser.add_argument("--compare", help="compare the results with a previously written JSON file")
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp()
+    results = []
+    try:
+        print "{:>7} {:>6} {:>5} {:>5} {:>9} {:>9} {:>9} {:>10}".format(
+            "items", "fields", "depth", "rules", "scan (s)", "match (s)", "compile", "peak (MB)")
+        for items, metadata, depth in itertools.product(args.sizes, args.metadata, args.depth):
+            path = os.path.join(base, "{}-{}-{}".format(items, metadata, depth))
+            generate_site(path, items=items, metadata=metadata, depth=depth)
+            for rules in args.rules:
+                result = run_configuration(path, rules, args.backend)
+                result.update(items=items, metadata=metadata, depth=depth, rules=rules, backend=args.backend)
+                results.append(result)
+                print "{:>7} {:>6} {:>5} {:>5} {:>9.3f} {:>9.3f} {:>9.3f} {:>10.1f}".format(
+                    items, metadata, depth, rules, result["scan"], result["match"], result["compile"],
+                    result["peak_rss"] / 1024.0 / 1024.0)
+            shutil.rmtree(path)
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+    data = {"commit": commit(), "python": platform.python_version(), "results": results}
+    if args.output:
+        with open(args.output, "wb") as file:
+            json.dump(data, file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, "rb") as file:
+            compare(results, json.load(file))
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
 import compiler
 import site
 import item
+import cache
 
 Compiler = compiler.Compiler
 Site = site.Site
-Item = item.Item
\ No newline at end of file
+Item = item.Item
+CompileError = compiler.CompileError
+ResultCache = cache.ResultCache
\ No newline at end of file
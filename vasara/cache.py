@@ -0,0 +1,131 @@
+import hashlib
+import io
+import json
+import os
+import threading
+
+from vasara.item import _encode
+
+class ResultCache(object):
+    """A persistent, content-addressed cache of filter and templater results. Results are stored as
+    files in a directory, keyed by a hash of the item's filename, source, metadata, the identities of
+    its filters and templater (see :func:`~vasara.item.callable_identity`), its route (for templater
+    results) and :attr:`~ResultCache.version`.
+    When the cache grows over :attr:`~ResultCache.max_size`, the least recently used results are
+    removed.
+
+    Set a cache as :attr:`Site.cache` to use it."""
+
+    def __init__(self, path, max_size=256 * 1024 * 1024, version="", templates=False):
+        """Constructor.
+
+        :param path: absolute path to the cache directory
+        :param max_size: maximum size of the cache in bytes
+        :param version: a string that is included in every key. Change it to invalidate the cache.
+        :param templates: if ``True``, templater results are cached as well. Results are discarded
+                          when the items they read change (see :attr:`Site.dependencies`), but other
+                          inputs like template files have to be covered by :attr:`~ResultCache.version`."""
+        self.path = path
+        """Absolute path to the cache directory."""
+        self.max_size = max_size
+        """Maximum size of the cache in bytes."""
+        self.version = version
+        """A string included in every key."""
+        self.templates = templates
+        """Specifies if templater results are cached."""
+        self._size = None
+        self._lock = threading.Lock()
+
+    def key(self, *parts):
+        """Generates a cache key.
+
+        :param parts: strings identifying the result
+        :returns: key"""
+        hash = hashlib.sha1(_encode(self.version))
+        for part in parts:
+            hash.update("\0")
+            hash.update(_encode(part))
+        return hash.hexdigest()
+
+    def get(self, key):
+        """Gets a cached result and marks it as recently used.
+
+        :param key: the result's key
+        :returns: the result or ``None`` if it isn't cached"""
+        path = self._path(key)
+        try:
+            with io.open(path, "rb") as file:
+                data = file.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            return None
+
+    def put(self, key, value):
+        """Caches a result. Values that can't be serialized as JSON aren't cached.
+
+        :param key: the result's key
+        :param value: the result: a JSON serializable value
+        :returns: ``True`` if the value was cached"""
+        from vasara.compiler import write_file
+
+        try:
+            data = json.dumps(value)
+        except (TypeError, ValueError):
+            return False
+
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        write_file(path, data)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._measure()
+            else:
+                self._size += len(data)
+            if self._size > self.max_size:
+                self._evict()
+        return True
+
+    def _path(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def _files(self):
+        # Lists the cached results as tuples: (last use, size, path)
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _measure(self):
+        return sum(size for used, size, path in self._files())
+
+    def _evict(self):
+        # Removes the least recently used results until the cache is below 90% of its maximum size,
+        # so that eviction doesn't happen on every write.
+        files = sorted(self._files())
+        self._size = sum(size for used, size, path in files)
+        target = self.max_size * 0.9
+        for used, size, path in files:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
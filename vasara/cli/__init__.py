@@ -1,30 +1,147 @@
 import sys
 import os
+import time
 import argparse
 
 def main():
-    compiler = get_compiler()
     parser = argparse.ArgumentParser(description="A static site generator.")
     subparsers = parser.add_subparsers(dest="command")
 
     compile = subparsers.add_parser("compile")
+    compile.add_argument("--profile", metavar="PATH", help="measure the build and write the results to PATH")
+    compile.add_argument("--profile-format", choices=("json", "chrome"), default="json",
+                         help="json for a summary or chrome for a Chrome trace")
+    compile.add_argument("--shard", type=shard, metavar="I/N", help="only compile the I:th of N shards of the items")
+    compile.add_argument("--low-memory", action="store_true",
+                         help="release each item's contents from memory once it has been written")
+
+    merge = subparsers.add_parser("merge-manifests", help="merge the manifests of a sharded build")
+    merge.add_argument("--shards", type=int, required=True, help="the number of shards")
+
+    watch = subparsers.add_parser("watch")
+    watch.add_argument("--interval", type=float, default=1.0, help="polling interval when inotify isn't available")
+    watch.add_argument("--debounce", type=float, default=0.1, help="time to wait for more changes before rebuilding")
 
-    #server = subparsers.add_parser("server")
-    #server.add_argument("--port", type=int, default=8000)
-    #server.add_argument("--listen", type=str, default="127.0.0.1")
+    server = subparsers.add_parser("server")
+    server.add_argument("--port", type=int, default=8000)
+    server.add_argument("--listen", type=str, default="127.0.0.1")
+    server.add_argument("--cache-size", type=int, default=256, help="maximum number of rendered pages to cache")
 
     args = parser.parse_args()
+    if args.command == "compile" and args.profile:
+        profile_site(args.profile, args.profile_format, shard=args.shard, low_memory=args.low_memory)
+        return
+
+    compiler = get_compiler()
     if args.command == "compile":
+        if args.shard is not None:
+            compiler.shard = args.shard
+        if args.low_memory:
+            compiler.release_items = True
         compiler.compile()
+        print_compiled()
+    elif args.command == "merge-manifests":
+        if compiler.manifest_path is None:
+            sys.exit("The compiler has no manifest path. Exiting.")
+        compiler.merge_shards(args.shards)
+        print "Merged {} manifests into {}.".format(args.shards, compiler.manifest_path)
+    elif args.command == "watch":
+        watch_site(compiler, interval=args.interval, debounce=args.debounce)
+    elif args.command == "server":
+        serve_site(compiler.site, listen=args.listen, port=args.port, cache_size=args.cache_size)
+
+def shard(value):
+    """Parses a shard argument like ``2/4``."""
+    try:
+        number, count = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Shards are given as I/N, for example 2/4.")
+    if not 1 <= number <= count:
+        raise argparse.ArgumentTypeError("The shard number must be between 1 and {}.".format(count))
+    return number, count
+
+def print_compiled():
+    from vasara.profiler import peak_rss
+
+    usage = peak_rss()
+    if usage is None:
         print "Compiled."
+    else:
+        print "Compiled. Peak memory usage: {:.1f} MB.".format(usage / 1024.0 / 1024.0)
+
+def profile_site(path, format="json", shard=None, low_memory=False):
+    """Compiles the site with profiling enabled, prints a summary and writes the measurements."""
+    from vasara import profiler
+
+    active = profiler.enable(trace=format == "chrome")
+    try:
+        with profiler.measure("cli", "load"):
+            compiler = get_compiler()
+        if shard is not None:
+            compiler.shard = shard
+        if low_memory:
+            compiler.release_items = True
+        compiler.compile()
+    finally:
+        profiler.disable()
+        active.save(path, format=format)
+    print "Compiled."
+    print
+    print "\n".join(active.summary())
+    print
+    print "Profile written to {}.".format(path)
+
+def watch_site(compiler, interval=1.0, debounce=0.1):
+    """Compiles the site and keeps rebuilding the affected items whenever the site's items change.
+    The site is kept in memory between rebuilds."""
+    from vasara.compiler import CompileError
+    from vasara.watcher import create_watcher
+
+    site = compiler.site
+    watcher = create_watcher(site.items_path, interval=interval)
+    try:
+        compiler.compile()
+        print "Compiled. Watching {} for changes.".format(site.items_path)
+        while True:
+            paths = watcher.changes(debounce=debounce)
+            start = time.time()
+            changed, removed = site.rescan(paths)
+            if not changed and not removed:
+                continue
+            try:
+                compiler.compile(keys=changed + removed)
+            except CompileError as e:
+                for key, error in e.errors:
+                    print error
+                print e
+            print "Rebuilt {} item(s) and removed {} in {:.3f}s.".format(len(changed), len(removed), time.time() - start)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+def serve_site(site, listen="127.0.0.1", port=8000, cache_size=256):
+    """Serves the site's items from memory, rendering them on demand."""
+    from vasara.server import Server
+
+    server = Server(site, listen=listen, port=port, cache_size=cache_size)
+    server.watch()
+    print "Serving on http://{}:{}/".format(listen, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
 
 # TODO: Hacky. Is there a better way to do this?
 def get_compiler():
     """Attempts to import a function called get_vasara_compiler from the current working
     directory. This will be used by the command-line tools."""
-    sys.path.append(os.getcwd())
+    if os.getcwd() not in sys.path:
+        sys.path.append(os.getcwd())
     try:
-        result = reload(__import__("__init__"))
+        # Importing runs the module, so it's only reloaded if it has been imported before
+        result = sys.modules.get("__init__")
+        result = reload(result) if result is not None else __import__("__init__")
         if not hasattr(result, "get_vasara_compiler"):
             raise ImportError
     except ImportError as e:
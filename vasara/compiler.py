@@ -1,35 +1,953 @@
-from vasara.item import Item
-from vasara.site import Site
+from vasara import profiler
+from vasara.item import Item, _encode, callable_identity, chunks, filter_items
+from vasara.site import Site, is_membership
 
+import hashlib
 import io
+import json
 import os
+import re
+import sys
+import threading
+import traceback
+
+# Modules that are slow to import and only needed by some builds (multiprocessing, Queue, shutil,
+# tempfile, vasara.postprocess and vasara.index) are imported where they're used, since this module
+# is imported every time the command line tool starts.
+
+MANIFEST_VERSION = 1
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# The umask can only be read by setting it
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+BACKENDS = ("serial", "threads", "processes", "pipeline")
+"""Available compilation backends. See :attr:`Compiler.backend`."""
+
+class CompileError(Exception):
+    """Raised after compilation if one or more items could not be built. The items that could be built
+    have still been written."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        """A list of tuples: [(item key, formatted traceback)]"""
+        super(CompileError, self).__init__("{} item(s) failed to compile: {}".format(
+            len(errors), ", ".join(key for key, error in errors)))
 
 class Compiler(object):
 
-    def __init__(self, site, output_path):
+    def __init__(self, site, output_path, manifest_path=None, backend="serial", workers=None, link_assets=False,
+                 shard=None, queue_size=64, release_items=False, index_path=None, index_fields=(),
+                 batch_size=256):
         self.site = site
         self.output_path = output_path
         """Absolute path to the output directory in disk."""
+        self.manifest_path = manifest_path
+        """Absolute path to the build manifest. If set, compilation is incremental: only items whose
+        source, route, filters or templater have changed since the last build are written."""
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend {}. Available backends: {}".format(backend, ", ".join(BACKENDS)))
+        self.backend = backend
+        """How items are rendered: ``serial`` renders items one at a time, ``threads`` uses a thread pool
+        and ``processes`` a process pool. The ``processes`` backend requires a platform that supports
+        ``fork``. ``pipeline`` reads, renders and writes items in separate threads connected by
+        bounded queues, so that reading and writing files overlaps with filtering and templating."""
+        self.workers = workers
+        """The number of workers used by the ``threads`` and ``processes`` backends, or ``None`` for
+        the number of CPUs."""
+        self.queue_size = queue_size
+        """The maximum number of items waiting between the stages of the ``pipeline`` backend."""
+        self.release_items = release_items
+        """If ``True``, each item's contents are released from memory once the item has been written
+        along with the items it read (see :meth:`Item.release`), so that memory usage doesn't grow
+        with the size of the site. Items that are needed again later, for example by the templaters
+        of other items, are read and filtered again. Set :attr:`Site.cache` to avoid filtering them
+        twice."""
+        self.batch_size = batch_size
+        """The maximum number of items passed to a batch filter at once (see
+        :func:`~vasara.item.batch_filter`). Items are built in chunks of at most this size, and the
+        items of each chunk that share filters are filtered together right before they're rendered,
+        so that batching doesn't keep more items in memory than a chunk."""
+        self.link_assets = link_assets
+        """If ``True``, passthrough items (see :meth:`Site.passthrough`) are hardlinked to the output
+        directory instead of copied when possible."""
+        if shard is not None and not 1 <= shard[0] <= shard[1]:
+            raise ValueError("Invalid shard {}/{}.".format(*shard))
+        self.shard = shard
+        """A tuple: (shard number, shard count), for example ``(2, 4)`` for the second of four shards.
+        If set, only the items in the shard are compiled (see :func:`shard_of`), so that a build can be
+        split across several processes or machines writing to the same output directory.
+
+        The previous manifest is read from :attr:`~Compiler.manifest_path`, but the shard's manifest
+        is written to :func:`shard_manifest_path`. Merge the shards' manifests with
+        :meth:`~Compiler.merge_shards` once every shard has been compiled."""
+        self.index_path = index_path
+        """Absolute path to the output index. If set, every output is listed in the index as it's
+        written: one JSON object per line (see :func:`~vasara.index.read_index`), with the output's
+        route, content hash, size and modification time and the item's
+        :attr:`~Compiler.index_fields`. The entries of unchanged outputs are carried over from the
+        previous index, so an incremental build only updates the entries it wrote. Deploy tools can
+        compare indexes to find changed outputs, and :func:`~vasara.index.write_sitemap` turns an
+        index into a sitemap.
+
+        Sharded builds write the index to :func:`shard_manifest_path` of the path, like the manifest."""
+        self.index_fields = list(index_fields)
+        """Metadata fields of items to include in the output index, for example ``["title", "tags"]``
+        for a search index."""
+        self.postprocessors = []
+        """Post-processors by route, as tuples: [(compiled expression, processor)]. See
+        :meth:`~Compiler.postprocess`."""
+        self.compressors = []
+        """Precompression formats by route, as tuples: [(compiled expression, formats)]. See
+        :meth:`~Compiler.precompress`."""
+        self.manifest = None
+        """The build manifest of the last compilation: a dictionary of entries by item key."""
+        self._directories = set()
+        self._indexed = {}
+        self._memberships = {}
+
+    def postprocess(self, expression, processor):
+        """Processes the outputs whose routes match a regular expression before they're written, for
+        example to minify them. Post-processors run in the compiler's workers, in the order they were
+        added. Outputs of passthrough items are read and processed as well.
+
+        :param expression: regular expression to match against :attr:`Item.file_route`
+        :param processor: a callable that takes the output as a byte string and returns the processed
+                          output. See :mod:`vasara.postprocess` for minifiers."""
+        self.postprocessors.append((re.compile(expression), processor))
+
+    def precompress(self, expression, formats=None):
+        """Writes precompressed variants (for example ``index.html.gz``) next to the outputs whose
+        routes match a regular expression, so that web servers and CDNs can serve them as they are.
+        Outputs that haven't changed aren't compressed again, and variants that wouldn't be smaller
+        than the output aren't written.
+
+        :param expression: regular expression to match against :attr:`Item.file_route`
+        :param formats: list of formats (default: every available format, see
+                        :data:`~vasara.postprocess.COMPRESSORS`)
+        :raises: ``ValueError`` if a format isn't available"""
+        from vasara.postprocess import COMPRESSORS
 
-    def compile(self):
-        """Compiles and writes all the items to disk."""
+        formats = sorted(COMPRESSORS) if formats is None else list(formats)
+        for format in formats:
+            if format not in COMPRESSORS:
+                raise ValueError("Unknown or unavailable compression format {}. Available formats: {}".format(
+                    format, ", ".join(sorted(COMPRESSORS))))
+        self.compressors.append((re.compile(expression), formats))
+
+    def compile(self, keys=None):
+        """Compiles and writes all the items to disk.
+
+        If :attr:`~Compiler.manifest_path` is set, unchanged items are skipped. The outputs of removed
+        items are deleted.
+
+        :param keys: list of item keys to compile (default: all items). Keys that no longer exist in
+                     :attr:`Site.items` have their outputs removed.
+        :raises: :class:`CompileError` if any of the items failed to build"""
         if not os.path.exists(self.output_path):
             os.makedirs(self.output_path)
+        self._directories = set()
+        self._indexed = {}
+        self._memberships = {}
+
+        # Sharded builds read the merged manifest of the previous build, which includes the items of
+        # other shards. They're only used to find out if items of this shard depend on them.
+        everything = self.manifest if self.manifest is not None else self.load_manifest()
+        previous = self._in_shard(everything)
+        if keys is None:
+            manifest = {}
+            keys = self.site.items.keys()
+        else:
+            manifest = dict(previous)
+        keys = self._in_shard(keys)
+        pending = []
+
+        with profiler.measure("compiler", "prepare"):
+            for key in keys:
+                item = self.site.items.get(key)
+                if item is None:
+                    manifest.pop(key, None)
+                    continue
+
+                route = item.file_route
+
+                if route is None:
+                    print "Item {} has no route. Skipping.".format(item.filename)
+                    manifest.pop(key, None)
+                    continue
+
+                path = os.path.join(self.output_path, route)
+                old = previous.get(key)
+                entry = self._entry(item, old)
+                manifest[key] = entry
+
+                if (self.manifest_path is not None and _same(old, entry) and os.path.exists(path)
+                        and self._same_memberships(old.get("memberships", {}))):
+                    entry["dependencies"] = old.get("dependencies", [])
+                    if "memberships" in old:
+                        entry["memberships"] = old["memberships"]
+                    continue
+                pending.append(key)
+
+            # Items that read changed or removed items have to be rebuilt as well
+            removed = [key for key in previous if key not in manifest]
+            changed = pending + removed + self._changed_elsewhere(everything, manifest)
+            for key in self._dependents(everything, changed) - set(pending):
+                item = self.site.items.get(key)
+                if key not in manifest or item is None:
+                    continue
+                item.unload()
+                pending.append(key)
+
+        errors = [(key, error) for key, error in self._run(pending) if error is not None]
+
+        failed = set(key for key, error in errors)
+        for key in pending:
+            if key not in failed:
+                dependencies = self.site.dependencies.get(key, ())
+                manifest[key]["dependencies"] = sorted(dependency for dependency in dependencies
+                                                       if not is_membership(dependency))
+                memberships = dict((dependency, self._membership(dependency)) for dependency in dependencies
+                                   if is_membership(dependency))
+                if memberships:
+                    manifest[key]["memberships"] = memberships
+
+        # Failed items are retried on the next compilation
+        for key, error in errors:
+            if key in previous:
+                manifest[key] = previous[key]
+            else:
+                del manifest[key]
 
-        for key, item in self.site.items.iteritems():
-            content = item.templated
-            route = item.file_route
+        if self.shard is not None:
+            # Outputs that moved to items of other shards are still in use
+            routes = [item.file_route for item in self.site.items.itervalues() if item.file_route is not None]
+            self.remove_stale(previous, manifest, routes)
+        else:
+            self.remove_stale(previous, manifest)
+        self.save_manifest(manifest)
+        self.save_index(manifest)
+        self.manifest = manifest
 
-            if route is None:
-                print "Item {} has no route. Skipping.".format(item.filename)
+        if errors:
+            raise CompileError(errors)
+
+    def _in_shard(self, keys):
+        # Returns the keys (or manifest entries) that belong to the compiler's shard.
+        if self.shard is None:
+            return keys
+        number, count = self.shard
+        if isinstance(keys, dict):
+            return dict((key, entry) for key, entry in keys.iteritems() if shard_of(key, count) == number)
+        return [key for key in keys if shard_of(key, count) == number]
+
+    def _changed_elsewhere(self, previous, manifest):
+        # Finds the items of other shards that items of this shard depend on and that have changed
+        # or been removed since the previous build.
+        if self.shard is None or self.manifest_path is None:
+            return []
+        dependencies = set()
+        for key in manifest:
+            dependencies.update(previous.get(key, {}).get("dependencies", ()))
+        changed = []
+        for key in dependencies - set(manifest):
+            item = self.site.items.get(key)
+            if item is None or item.file_route is None or not _same(previous.get(key), self._entry(item, previous.get(key))):
+                changed.append(key)
+        return changed
+
+    def _membership(self, dependency):
+        # Hashes the members of a membership dependency once per compilation, before any item has
+        # been rendered if possible, so that filters changing metadata don't change the hash.
+        hash = self._memberships.get(dependency)
+        if hash is None:
+            hash = self._memberships[dependency] = self.site.membership(dependency)
+        return hash
+
+    def _same_memberships(self, memberships):
+        # Checks if the listings and queries of an item still find the same items.
+        return all(self._membership(dependency) == hash for dependency, hash in memberships.iteritems())
+
+    def _dependents(self, previous, keys):
+        # Finds the dependents of items using the dependencies recorded in this process and, for
+        # items that haven't been rendered in this process, the previous manifest.
+        dependencies = dict((key, entry.get("dependencies", ())) for key, entry in previous.iteritems())
+        dependencies.update(self.site.dependencies)
+        return self.site.dependents(keys, dependencies)
+
+    def _entry(self, item, previous):
+        # Builds the manifest entry of an item. Passthrough items are identified by their file
+        # information alone, since they're never read.
+        entry = {"route": item.file_route}
+        if self.manifest_path is None:
+            # Only the route is needed to remove the output later
+            return entry
+        if item.path is not None:
+            entry["size"] = item.size
+            entry["mtime"] = item.mtime
+        processors, formats = self._processing(item.file_route)
+        if processors or formats:
+            # Outputs are written again when their post-processors or compression formats change
+            parts = [callable_identity(processor) for processor in processors] + formats
+            entry["postprocess"] = hashlib.sha1("\n".join(parts)).hexdigest()
+        if item.passthrough:
+            entry["passthrough"] = True
+            return entry
+
+        # Avoids reading unchanged source files: if the file's size and modification time match the
+        # previous build, the previous hash is reused.
+        if (previous is not None and item.path is not None and item.size is not None
+                and previous.get("size") == item.size and previous.get("mtime") == item.mtime):
+            entry["hash"] = previous.get("hash")
+        else:
+            # Changed items aren't loaded here, since they'd stay in memory until they're built
+            entry["hash"] = item.hash_source()
+        entry["signature"] = item.signature
+        return entry
+
+    def build(self, key):
+        """Templates and writes a single item. Passthrough items are copied as they are.
+
+        :param key: the item's key in :attr:`Site.items`
+        :returns: tuple: (key, formatted traceback or ``None`` if the item was built)"""
+        try:
+            with profiler.measure("compiler", "build", key):
+                item = self.site.items[key]
+                hash = self._write(item, None if item.passthrough else item.templated)
+                self._written(key, item, hash)
+        except Exception:
+            return key, _format_error()
+        return key, None
+
+    def _written(self, key, item, hash=None):
+        # Indexes a written item before it's released.
+        if self.index_path is not None:
+            self._indexed[key] = self._index_entry(key, item, hash)
+        if self.release_items:
+            self._release(key)
+
+    def _index_entry(self, key, item, hash=None):
+        # Builds the output index entry of an item. The hash of the output is computed by _write
+        # while writing it: the file is only read back if it isn't given.
+        path = os.path.join(self.output_path, item.file_route)
+        with profiler.measure("compiler", "index"):
+            stat = os.stat(path)
+            if hash is None:
+                from vasara.index import digest
+                hash = digest(path)
+            entry = {"key": key, "route": item.file_route, "hash": hash,
+                     "size": stat.st_size, "mtime": stat.st_mtime}
+            if self.index_fields and not item.passthrough:
+                metadata = item.metadata
+                entry["metadata"] = dict((field, metadata[field]) for field in self.index_fields if field in metadata)
+        return entry
+
+    def _release(self, key):
+        # Releases a written item and the items it read: the latter would otherwise stay in memory
+        # if they were written before they were read.
+        for name in [key] + sorted(self.site.dependencies.get(key, ())):
+            if name in self.site.items:
+                self.site.items[name].release()
+
+    def _write(self, item, content):
+        # Writes an item's templated contents, or copies the source file of a passthrough item. The
+        # output is post-processed and compressed if the item's route has post-processors or
+        # precompression formats. Returns the SHA-1 hex digest of the output if the output index
+        # is enabled, None otherwise.
+        route = item.file_route
+        path = os.path.join(self.output_path, route)
+        self._makedirs(os.path.dirname(path))
+        processors, formats = self._processing(route)
+
+        data = None
+        hash = hashlib.sha1() if self.index_path is not None else None
+        if item.passthrough and not processors:
+            with profiler.measure("compiler", "copy"):
+                written = copy_file(item.path, path, link=self.link_assets, hash=hash)
+        else:
+            if item.passthrough:
+                with io.open(item.path, "rb") as file:
+                    content = file.read()
+            if processors or formats:
+                # Post-processing and compression need the whole output
+                data = "".join(chunks(content))
+                for processor in processors:
+                    with profiler.measure("postprocess", profiler.name(processor), item.filename):
+                        data = processor(data)
+                content = data
+            with profiler.measure("compiler", "write"):
+                written = write_file(path, content, hash=hash)
+
+        if formats:
+            self._compress(path, formats, written, data)
+        return None if hash is None else hash.hexdigest()
+
+    def _processing(self, route):
+        # Returns the post-processors and compression formats of a route as a tuple of lists.
+        processors = [processor for exp, processor in self.postprocessors if exp.match(route)]
+        formats = []
+        for exp, matched in self.compressors:
+            if exp.match(route):
+                formats.extend(format for format in matched if format not in formats)
+        return processors, formats
+
+    def _compress(self, path, formats, written, data):
+        # Writes the precompressed variants of an output. If the output didn't change, only missing
+        # variants are written.
+        from vasara.postprocess import COMPRESSORS
+
+        for format in formats:
+            suffix, compress = COMPRESSORS[format]
+            variant = path + suffix
+            if not written and os.path.exists(variant):
                 continue
+            if data is None:
+                with io.open(path, "rb") as file:
+                    data = file.read()
+            with profiler.measure("compress", format):
+                compressed = compress(data)
+            if len(compressed) < len(data):
+                write_file(variant, compressed)
+            else:
+                _remove(variant)
+
+    def _makedirs(self, path):
+        # Creates an output directory. Directories that are known to exist are cached so that they
+        # aren't checked again for every item.
+        if path in self._directories:
+            return
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # Another worker may have created the directory
+                if not os.path.isdir(path):
+                    raise
+        self._directories.add(path)
+
+    def _run(self, keys):
+        # Builds the specified items with the selected backend, in chunks that are batch filtered
+        # together.
+        if self.backend == "serial" or len(keys) < 2:
+            results = []
+            for chunk in _split(keys, self.batch_size):
+                results.extend(self._build_chunk(chunk))
+            return results
+        if self.backend == "pipeline":
+            return self._pipeline(keys)
+
+        # multiprocessing is only imported when needed, since it's slow to import
+        import multiprocessing
+        from multiprocessing.pool import ThreadPool
+
+        workers = self.workers or _cpu_count()
+
+        global _worker_compiler
+        if self.backend == "threads":
+            pool = ThreadPool(workers)
+            function = self._build_chunk
+        else:
+            # Forked workers inherit the compiler (and its site) from this process
+            _worker_compiler = self
+            pool = multiprocessing.Pool(workers)
+            function = _build_in_worker
+
+        chunks = _split(keys, max(1, min(self.batch_size, len(keys) // (workers * 4))))
+        try:
+            chunks = pool.map(function, chunks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _worker_compiler = None
+
+        results = []
+        if self.backend == "processes":
+            # Workers return their recorded dependencies, index entries and measurements along with
+            # the results
+            active = profiler.active()
+            for built, data in chunks:
+                for (key, error), dependencies, entry in built:
+                    self.site.dependencies.pop(key, None)
+                    if dependencies:
+                        self.site.dependencies[key] = set(dependencies)
+                    if entry is not None:
+                        self._indexed[key] = entry
+                    results.append((key, error))
+                if active is not None and data is not None:
+                    active.merge(data)
+        else:
+            for built in chunks:
+                results.extend(built)
+        return results
+
+    def _build_chunk(self, keys):
+        # Batch filters a chunk of items and builds them.
+        self._filter_batches([self.site.items[key] for key in keys])
+        return [self.build(key) for key in keys]
+
+    def _filter_batches(self, items):
+        with profiler.measure("compiler", "batch filter"):
+            try:
+                filter_items(items, self.batch_size)
+            except Exception:
+                # Items that couldn't be filtered in batches are filtered on their own when they're
+                # built, so that the error is reported for each item
+                pass
+
+    def _pipeline(self, keys):
+        # Reads items in one thread, renders them in this thread and writes them in another. The
+        # queues between the stages are bounded, so a slow stage doesn't let items pile up in memory.
+        # Every item passes through all the stages, along with the error of the stage that failed.
+        import Queue
+
+        loaded = Queue.Queue(self.queue_size)
+        rendered = Queue.Queue(self.queue_size)
+        stop = threading.Event()
+        results = []
+
+        def read():
+            for key in keys:
+                if stop.is_set():
+                    break
+                item = self.site.items[key]
+                error = None
+                if not item.passthrough:
+                    try:
+                        with profiler.measure("compiler", "read", key):
+                            item.load()
+                    except Exception:
+                        error = _format_error()
+                loaded.put((key, error))
+            loaded.put(None)
+
+        def write():
+            while True:
+                job = rendered.get()
+                if job is None:
+                    return
+                key, content, error = job
+                if error is None:
+                    try:
+                        item = self.site.items[key]
+                        hash = self._write(item, content)
+                        self._written(key, item, hash)
+                    except Exception:
+                        error = _format_error()
+                results.append((key, error))
+
+        reader = threading.Thread(target=read)
+        writer = threading.Thread(target=write)
+        reader.start()
+        writer.start()
+        finished = False
+        try:
+            while not finished:
+                # The items that have been read so far are batch filtered together
+                jobs = [loaded.get()]
+                while jobs[-1] is not None and len(jobs) < self.batch_size:
+                    try:
+                        jobs.append(loaded.get_nowait())
+                    except Queue.Empty:
+                        break
+                if jobs[-1] is None:
+                    finished = True
+                    jobs.pop()
+                self._filter_batches([self.site.items[key] for key, error in jobs if error is None])
+
+                for key, error in jobs:
+                    item = self.site.items[key]
+                    content = None
+                    if error is None and not item.passthrough:
+                        try:
+                            # Writing is measured separately in the writer thread
+                            with profiler.measure("compiler", "build", key):
+                                content = item.templated
+                        except Exception:
+                            error = _format_error()
+                    rendered.put((key, content, error))
+        finally:
+            rendered.put(None)
+            if not finished:
+                # Interrupted: unblock the reader
+                stop.set()
+                while loaded.get() is not None:
+                    pass
+            reader.join()
+            writer.join()
+        return results
+
+    def load_manifest(self):
+        """Loads the build manifest written by the previous compilation.
+
+        :returns: dictionary of manifest entries by item key (empty if there's no manifest)"""
+        if self.manifest_path is None or not os.path.exists(self.manifest_path):
+            return {}
+        with io.open(self.manifest_path, "rb") as file:
+            data = json.loads(file.read())
+        if data.get("version") != MANIFEST_VERSION:
+            return {}
+        return data["items"]
+
+    def save_manifest(self, manifest):
+        """Writes the build manifest. Sharded builds write it to :func:`shard_manifest_path`.
+
+        :param manifest: dictionary of manifest entries by item key"""
+        if self.manifest_path is None:
+            return
+        path = self.manifest_path
+        if self.shard is not None:
+            path = shard_manifest_path(path, *self.shard)
+        write_file(path, json.dumps({"version": MANIFEST_VERSION, "items": manifest}, sort_keys=True))
+
+    def save_index(self, manifest):
+        """Writes the output index (see :attr:`~Compiler.index_path`). Entries of the items written by
+        the last compilation replace their previous entries, the entries of unchanged items are read
+        from the previous index and removed items are left out. The previous index is sorted, so the
+        new entries are merged into it as it's read.
+
+        :param manifest: dictionary of manifest entries by item key"""
+        if self.index_path is None:
+            return
+        from vasara.index import index_lines, merge_entries, read_index
+
+        entries = dict((key, entry) for key, entry in self._indexed.iteritems() if key in manifest)
+        previous = os.path.exists(self.index_path)
+
+        def retained():
+            # The previous entries that are still valid
+            if previous:
+                for entry in read_index(self.index_path):
+                    key = entry["key"]
+                    if key in manifest and key not in entries and entry["route"] == manifest[key]["route"]:
+                        yield entry
+
+        missing = set(manifest).difference(entries)
+        missing.difference_update(entry["key"] for entry in retained())
+        for key in missing:
+            # The index didn't exist when the item was last written
+            item = self.site.items.get(key)
+            if item is not None and os.path.exists(os.path.join(self.output_path, item.file_route)):
+                entries[key] = self._index_entry(key, item)
+
+        path = self.index_path
+        if self.shard is not None:
+            path = shard_manifest_path(path, *self.shard)
+        fresh = sorted(entries.itervalues(), key=lambda entry: entry["route"])
+        write_file(path, index_lines(merge_entries(fresh, retained()), sort=False))
+
+    def merge_shards(self, count):
+        """Merges the manifests (and the output indexes, if :attr:`~Compiler.index_path` is set)
+        written by the shards of a sharded build (see :attr:`~Compiler.shard`) into
+        :attr:`~Compiler.manifest_path`, for the next build to read. The shards' manifests are
+        removed.
+
+        :param count: the number of shards
+        :raises: ``IOError`` if a shard's manifest is missing"""
+        merged = [(self.manifest_path, merge_manifests)]
+        if self.index_path is not None:
+            from vasara.index import merge_indexes
+            merged.append((self.index_path, merge_indexes))
+        for destination, merge in merged:
+            paths = [shard_manifest_path(destination, number, count) for number in range(1, count + 1)]
+            merge(destination, paths)
+            for path in paths:
+                os.remove(path)
+
+    def remove_stale(self, previous, manifest, routes=()):
+        """Removes outputs that were written by the previous compilation but are no longer produced
+        by any item (the item was removed or rerouted).
+
+        :param previous: the previous build manifest
+        :param manifest: the current build manifest
+        :param routes: other routes that are still in use"""
+        routes = set(entry["route"] for entry in manifest.itervalues()) | set(routes)
+        for key, entry in previous.iteritems():
+            if entry["route"] in routes:
+                continue
+            path = os.path.join(self.output_path, entry["route"])
+            if os.path.exists(path):
+                from vasara.postprocess import SUFFIXES
+                os.remove(path)
+                for suffix in SUFFIXES:
+                    _remove(path + suffix)
+                self._prune(os.path.dirname(path))
+
+    def _prune(self, path):
+        # Removes empty directories left behind by removed outputs, up to the output path.
+        output = os.path.abspath(self.output_path)
+        path = os.path.abspath(path)
+        while path != output and path.startswith(output) and not os.listdir(path):
+            os.rmdir(path)
+            path = os.path.dirname(path)
+
+
+def shard_of(key, count):
+    """Assigns an item to a shard by a stable hash of its key, so that every process and machine
+    assigns the same items to the same shards.
+
+    :param key: the item's key
+    :param count: the number of shards
+    :returns: shard number, from 1 to ``count``"""
+    return int(hashlib.sha1(_encode(key)).hexdigest()[:8], 16) % count + 1
+
+def shard_manifest_path(path, number, count):
+    """Returns the path of a shard's build manifest. See :attr:`Compiler.shard`.
+
+    :param path: path to the merged manifest
+    :param number: the shard's number, from 1 to ``count``
+    :param count: the number of shards
+    :returns: path"""
+    return "{}.shard-{}-of-{}".format(path, number, count)
+
+def merge_manifests(path, paths):
+    """Merges the build manifests of several shards into one.
+
+    :param path: path to the merged manifest
+    :param paths: paths to the shards' manifests"""
+    items = {}
+    for shard in paths:
+        with io.open(shard, "rb") as file:
+            data = json.loads(file.read())
+        if data.get("version") != MANIFEST_VERSION:
+            raise ValueError("Manifest {} has an unsupported version.".format(shard))
+        items.update(data["items"])
+    write_file(path, json.dumps({"version": MANIFEST_VERSION, "items": items}, sort_keys=True))
+
+def write_file(path, content, hash=None):
+    """Writes a file atomically: the content is written to a temporary file which then replaces the
+    destination. Nothing is written if the destination already has identical content, which keeps its
+    modification time intact.
+
+    The content may also be an iterable of strings (for example a generator returned by a templater).
+    The chunks are written as they're generated, so the whole content is never held in memory.
+
+    :param path: path to the destination file
+    :param content: the content to write: a string or an iterable of strings (unicode strings are
+                    encoded as UTF-8)
+    :param hash: optional ``hashlib`` object, updated with the content as it's written or compared,
+                 so that the file doesn't have to be read again to hash it
+    :returns: ``True`` if the file was written, ``False`` if it was unchanged"""
+    streamed = not isinstance(content, basestring)
+    if not streamed:
+        data = _encode(content)
+        if hash is not None:
+            hash.update(data)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        if size == len(data):
+            with io.open(path, "rb") as file:
+                if file.read() == data:
+                    return False
+
+    temporary = _temporary(path)
+    try:
+        with io.open(temporary, "wb") as file:
+            if streamed:
+                for chunk in chunks(content):
+                    if hash is not None:
+                        hash.update(chunk)
+                    file.write(chunk)
+            else:
+                file.write(data)
+        # Streamed content can only be compared with the destination once it has been written
+        if streamed and _identical(temporary, path):
+            _remove(temporary)
+            return False
+        _replace(temporary, path)
+    except:
+        _remove(temporary)
+        raise
+    return True
+
+def copy_file(source, destination, link=False, hash=None):
+    """Copies a file without reading it into Python when possible: on Linux, the kernel copies it
+    with ``sendfile``, which Python 2 only exposes through ``ctypes``. Elsewhere the file is copied in
+    blocks. The copy is skipped if the destination already has the same size and modification time
+    as the source. The source's modification time is preserved, and the destination is replaced
+    atomically.
+
+    If a hash is given, the file has to be read anyway: it's copied in blocks, which are hashed on the
+    way, instead of with ``sendfile``.
+
+    :param source: path to the source file
+    :param destination: path to the destination file
+    :param link: if ``True``, hardlinks the file instead of copying when possible
+    :param hash: optional ``hashlib`` object, updated with the file's contents
+    :returns: ``True`` if the file was copied, ``False`` if it was unchanged"""
+    stat = os.stat(source)
+    try:
+        existing = os.stat(destination)
+    except OSError:
+        pass
+    else:
+        # Copies keep the source's modification time to the microsecond (see os.utime below), so a
+        # file rewritten within the same second is still copied again
+        if existing.st_size == stat.st_size and abs(existing.st_mtime - stat.st_mtime) < 1e-6:
+            if hash is not None:
+                _hash_file(destination, hash)
+            return False
+
+    temporary = _temporary(destination)
+    try:
+        if link:
+            try:
+                os.remove(temporary)
+                os.link(source, temporary)
+                _replace(temporary, destination)
+            except (OSError, AttributeError):
+                # Different filesystems or no hardlink support: fall back to copying
+                pass
+            else:
+                if hash is not None:
+                    _hash_file(destination, hash)
+                return True
+
+        with io.open(source, "rb") as input:
+            with io.open(temporary, "wb") as output:
+                sendfile = _sendfile()
+                copied = False
+                if hash is not None:
+                    while True:
+                        block = input.read(COPY_BUFFER_SIZE)
+                        if not block:
+                            break
+                        hash.update(block)
+                        output.write(block)
+                    copied = True
+                elif sendfile is not None and stat.st_size > 0:
+                    try:
+                        offset = 0
+                        while offset < stat.st_size:
+                            sent = sendfile(output.fileno(), input.fileno(), offset, stat.st_size - offset)
+                            if sent == 0:
+                                break
+                            offset += sent
+                        copied = True
+                    except OSError:
+                        # sendfile doesn't support every kind of file
+                        output.seek(0)
+                        output.truncate()
+                if not copied:
+                    import shutil
+                    shutil.copyfileobj(input, output, COPY_BUFFER_SIZE)
+        os.utime(temporary, (stat.st_atime, stat.st_mtime))
+        _replace(temporary, destination)
+    except:
+        _remove(temporary)
+        raise
+    return True
+
+def _hash_file(path, hash):
+    # Updates a hash with the contents of a file, read in blocks.
+    with io.open(path, "rb") as file:
+        while True:
+            block = file.read(COPY_BUFFER_SIZE)
+            if not block:
+                return
+            hash.update(block)
+
+_SENDFILE = []
+
+def _sendfile():
+    # Returns a function with the signature of Python 3's os.sendfile, or None if the platform
+    # doesn't have one. ctypes is only imported on the first copy.
+    if not _SENDFILE:
+        _SENDFILE.append(getattr(os, "sendfile", None) or _libc_sendfile())
+    return _SENDFILE[0]
+
+def _libc_sendfile():
+    # sendfile(2) of Linux through ctypes. Other platforms' sendfile can't copy to regular files.
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        function = getattr(libc, "sendfile64", None) or libc.sendfile
+    except (ImportError, OSError, AttributeError):
+        return None
+    function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    function.restype = ctypes.c_ssize_t
+
+    def sendfile(output, input, offset, count):
+        position = ctypes.c_int64(offset)
+        sent = function(output, input, ctypes.byref(position), count)
+        if sent < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return sent
+    return sendfile
+
+def _temporary(path):
+    # Creates a temporary file next to the destination, so that it can be renamed over it. mkstemp
+    # creates files readable only by the owner, so the permissions are reset according to the umask.
+    import tempfile
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                                             prefix=".{}.".format(os.path.basename(path)), suffix=".tmp")
+    os.close(descriptor)
+    os.chmod(temporary, 0666 & ~UMASK)
+    return temporary
+
+def _identical(first, second):
+    # Compares two files in blocks. filecmp isn't used since it caches every comparison.
+    try:
+        if os.path.getsize(first) != os.path.getsize(second):
+            return False
+    except OSError:
+        return False
+    with io.open(first, "rb") as a:
+        with io.open(second, "rb") as b:
+            while True:
+                block = a.read(COPY_BUFFER_SIZE)
+                if block != b.read(COPY_BUFFER_SIZE):
+                    return False
+                if not block:
+                    return True
+
+def _replace(source, destination):
+    # os.rename can't replace existing files on Windows
+    if sys.platform == "win32" and os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _cpu_count():
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+def _format_error():
+    return "".join(traceback.format_exception(*sys.exc_info()))
+
+_worker_compiler = None
 
-            path = os.path.join(self.output_path, route)
-            path_dir = os.path.dirname(path)
+def _build_in_worker(keys):
+    # Builds a chunk of items in a worker process. Returns a tuple: ([(result, dependencies, index
+    # entry)], profiler measurements)
+    active = profiler.active()
+    if active is not None:
+        active.clear()
+    built = []
+    for result in _worker_compiler._build_chunk(keys):
+        key = result[0]
+        dependencies = list(_worker_compiler.site.dependencies.get(key, ()))
+        built.append((result, dependencies, _worker_compiler._indexed.pop(key, None)))
+    return built, active.data() if active is not None else None
 
-            if not os.path.exists(path_dir):
-                os.makedirs(path_dir)
+def _split(keys, size):
+    return [keys[start:start + size] for start in range(0, len(keys), size)]
 
-            file = io.open(path, "wb")
-            file.write(content)
-            file.close()
\ No newline at end of file
+def _same(previous, entry):
+    # Compares manifest entries, ignoring the dependencies recorded when the item was built.
+    if previous is None:
+        return False
+    return dict((key, value) for key, value in previous.iteritems()
+                if key not in ("dependencies", "memberships")) == entry
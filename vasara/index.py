@@ -0,0 +1,107 @@
+import hashlib
+import heapq
+import io
+import json
+import re
+import time
+import urllib
+from xml.sax.saxutils import escape
+
+from vasara.item import _encode
+
+BUFFER_SIZE = 1024 * 1024
+
+def digest(path):
+    """Hashes a file in blocks.
+
+    :param path: path to the file
+    :returns: SHA-1 hex digest of the file's contents"""
+    hash = hashlib.sha1()
+    with io.open(path, "rb") as file:
+        while True:
+            block = file.read(BUFFER_SIZE)
+            if not block:
+                return hash.hexdigest()
+            hash.update(block)
+
+def read_index(path):
+    """Reads an output index written by the compiler (see :attr:`Compiler.index_path`) one entry at
+    a time, so that the whole index is never held in memory.
+
+    :param path: path to the index
+    :returns: generator of entries: dictionaries with the output's ``route``, the ``key`` of the
+              item that produced it, the output's ``hash``, ``size`` and ``mtime`` and the item's
+              indexed ``metadata`` fields"""
+    with io.open(path, "rb") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+def index_lines(entries, sort=True):
+    """Serializes output index entries as JSON Lines, sorted by route so that unchanged entries
+    produce identical lines from build to build.
+
+    :param entries: iterable of entries
+    :param sort: if ``False``, the entries are expected to be sorted already and are serialized one
+                 at a time
+    :returns: generator of lines"""
+    if sort:
+        entries = sorted(entries, key=lambda entry: entry["route"])
+    for entry in entries:
+        yield json.dumps(entry, sort_keys=True) + "\n"
+
+def merge_entries(*iterables):
+    """Merges iterables of output index entries that are each sorted by route, without holding them
+    in memory.
+
+    :param iterables: iterables of entries sorted by route
+    :returns: generator of entries sorted by route"""
+    for route, entry in heapq.merge(*[_by_route(entries) for entries in iterables]):
+        yield entry
+
+def _by_route(entries):
+    # Decorates entries with their route for heapq.merge, which can't be given a key in Python 2.
+    for entry in entries:
+        yield entry["route"], entry
+
+def merge_indexes(path, paths):
+    """Merges the output indexes of several shards into one. Each index is sorted, so they're merged
+    as they're read.
+
+    :param path: path to the merged index
+    :param paths: paths to the shards' indexes"""
+    from vasara.compiler import write_file
+
+    write_file(path, index_lines(merge_entries(*[read_index(shard) for shard in paths]), sort=False))
+
+def write_sitemap(index_path, path, base_url, routes=r".*\.html$"):
+    """Writes a `sitemap <https://www.sitemaps.org/protocol.html>`_ from an output index without
+    rendering any items. Since unchanged outputs keep their modification times, the ``lastmod`` of
+    each page is the time its output last changed.
+
+    :param index_path: path to the output index (see :attr:`Compiler.index_path`)
+    :param path: path to the sitemap
+    :param base_url: the site's URL, for example ``https://example.com/``
+    :param routes: regular expression of the routes to include
+    :returns: ``True`` if the sitemap was written, ``False`` if it was unchanged"""
+    from vasara.compiler import write_file
+
+    expression = re.compile(routes)
+    base_url = base_url.rstrip("/") + "/"
+
+    def lines():
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+        for entry in read_index(index_path):
+            route = entry["route"]
+            if not expression.match(route):
+                continue
+            # Directory indexes are linked without the file name
+            if route == "index.html" or route.endswith("/index.html"):
+                route = route[:-len("index.html")]
+            lastmod = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(entry["mtime"]))
+            url = base_url + urllib.quote(_encode(route))
+            yield "<url><loc>{}</loc><lastmod>{}</lastmod></url>\n".format(escape(url), lastmod)
+        yield "</urlset>\n"
+
+    return write_file(path, lines())
@@ -1,38 +1,257 @@
+import functools
+import hashlib
+import io
 import json
 import re
+import sys
+import threading
+
+from vasara import profiler
 
 # This regex pattern has been shamelessly lifted from Mynt, licensed under the
 # BSD license. Mynt is available at https://github.com/Anomareh/mynt
+# Items are parsed with split_front_matter, which accepts the same syntax without running a regex
+# over the whole source.
 MATCHER = re.compile(r"\A---\s+^(.+?)$\s+---\s*(.*)\Z", re.M | re.S)
 
+# The characters matched by \s in MATCHER
+WHITESPACE = " \t\n\r\f\v"
+
+# The size of the blocks in which source files are hashed
+BLOCK_SIZE = 1024 * 1024
+
+# Guards the creation of per-item filter locks
+_LOCK = threading.Lock()
+
 class Item(object):
+    """An item of a site. Items have a fixed set of attributes (``__slots__``) to keep large sites
+    small in memory. Subclass :class:`Item` to add attributes."""
+
+    __slots__ = ("filename", "site", "path", "size", "mtime", "file_route", "filtered", "templater", "passthrough",
+                 "_filters", "_source", "_raw", "_metadata", "_filtered_content", "_source_hash", "_lock",
+                 "_progress")
+
+    def __init__(self, filename, site, raw=None, route=None, path=None, size=None, mtime=None):
+        """Constructor. Either ``raw`` or ``path`` must be given. If only ``path`` is given, the item is
+        loaded lazily: the file isn't read until :attr:`~Item.raw_content`, :attr:`~Item.metadata` or
+        :attr:`~Item.content` is first needed.
 
-    def __init__(self, filename, site, raw, route=None):
+        :param filename: the item's filename (key)
+        :param site: the item's site
+        :param raw: raw contents of the item, including metadata, or a callable that returns them
+                    (called whenever the item is loaded)
+        :param route: the item's output path
+        :param path: absolute path to the item's source file
+        :param size: size of the source file in bytes
+        :param mtime: modification time of the source file"""
         self.filename = filename
         """The item's filename."""
         self.site = site
         """The item's :class:`Site`."""
-        self.raw_content = raw
-        """The raw, unprocessed contents of the item."""
+        self.path = path
+        """Absolute path to the item's source file, or ``None`` if the item wasn't read from disk."""
+        self.size = size
+        """Size of the item's source file in bytes (if known)."""
+        self.mtime = mtime
+        """Modification time of the item's source file (if known)."""
         self.file_route = route
         """The item's output path."""
-        self.filters = []
-        """A list of the item's filters. See :func:`example.filter`."""
+        self._filters = ()
         self.filtered = False
         """Specifies if the item has already gone through filtering."""
         self.templater = None
         """The item's templater. See :func:`example.templater`."""
-        self.metadata = {}
-        """Any metadata associated with the file."""
+        self.passthrough = False
+        """If ``True``, the item's source file is copied to its route as it is: it's never read,
+        filtered or templated. See :meth:`Site.passthrough`."""
+
+        self._source = raw
+        self._raw = None
+        self._metadata = None
+        self._filtered_content = None
+        self._source_hash = None
+        self._lock = None
+        self._progress = None
+
+    @property
+    def filters(self):
+        """A list of the item's filters. See :func:`example.filter`.
+
+        Items with the same filters share a single tuple of them, and this list is a copy of it:
+        changes to the list are written back to the item. Assigning a new list works as well."""
+        return _FilterList(self)
+
+    @filters.setter
+    def filters(self, value):
+        filters = tuple(value)
+        self._filters = self.site._chain(filters) if self.site is not None else filters
+
+    def _load(self):
+        # Reads and parses the item's source if it hasn't been done yet.
+        if self._source_hash is not None:
+            return
+        with self._filter_lock():
+            if self._source_hash is not None:
+                return
+            raw = self._read_source()
+            metadata, offset = split_front_matter(raw)
+            content = raw[offset:] if offset else raw
+            # The metadata may already have been read (and modified) by itself
+            if self._metadata is None:
+                self._metadata = json.loads(metadata) if metadata is not None else {}
 
-        # Read metadata if it exists
-        match = MATCHER.match(self.raw_content)
-        if match and len(match.groups()) == 2:
-            self.metadata = json.loads(match.groups()[0])
-            self.raw_content = match.groups()[1]
+            self._filtered_content = content
+            self._raw = content
+            self._source_hash = hashlib.sha1(_encode(raw)).hexdigest()
 
-        self.filtered_content = self.raw_content
+    def _read_source(self):
+        if self._source is not None:
+            return self._source() if callable(self._source) else self._source
+        if self.path is None:
+            raise ValueError("Item {} has no contents and no source path.".format(self.filename))
+        with io.open(self.path, "r") as file:
+            return file.read()
+
+    def _load_metadata(self):
+        # Reads only the item's metadata if it hasn't been read yet. The rest of the source file is
+        # read when it's needed.
+        if self._metadata is not None:
+            return
+        if self._source is not None or self.path is None:
+            self._load()
+            return
+        with self._filter_lock():
+            if self._metadata is None:
+                self._metadata = read_metadata(self.path)
+
+    def load(self):
+        """Reads and parses the item's source if it hasn't been done yet. For convenience, returns
+        itself.
+
+        :returns: self"""
+        self._load()
+        return self
+
+    def unload(self):
+        """Drops the item's contents and filtering results from memory. They will be read from the
+        source file again when needed. Items that weren't read from a file keep their raw contents
+        and are parsed again."""
+        if self._source is None and self.path is None:
+            return
+        if self.site is not None:
+            # Dependencies are recorded again when the item is filtered and templated again
+            self.site.dependencies.pop(self.filename, None)
+            self.site.invalidate_queries()
+        self.release()
+
+    def release(self):
+        """Drops the item's contents and filtering results from memory, assuming that its source
+        hasn't changed: unlike :meth:`~Item.unload`, the item's recorded dependencies are kept. The
+        item is read and filtered again (or its results are fetched from :attr:`Site.cache`) if it's
+        needed later. Items that weren't read from a file or generated keep their raw contents."""
+        if self._source is None and self.path is None:
+            return
+        with self._filter_lock():
+            self._source_hash = None
+            self._raw = None
+            self._metadata = None
+            self._filtered_content = None
+            self._progress = None
+            self.filtered = False
+
+    @property
+    def loaded(self):
+        """Specifies if the item's contents have been read into memory."""
+        return self._source_hash is not None
+
+    @property
+    def raw_content(self):
+        """The raw, unprocessed contents of the item. Once the item has been filtered, the raw
+        contents are dropped from memory and read from the source again if needed."""
+        self._load()
+        self._read()
+        raw = self._raw
+        if raw is None:
+            with self._filter_lock():
+                raw = self._raw
+                if raw is None:
+                    source = self._read_source()
+                    raw = self._raw = source[split_front_matter(source)[1]:]
+        return raw
+
+    @raw_content.setter
+    def raw_content(self, value):
+        self._load()
+        self._raw = value
+
+    @property
+    def metadata(self):
+        """Any metadata associated with the file. Reading the metadata of an item that hasn't been
+        loaded only reads the beginning of its source file, up to the end of the metadata block."""
+        metadata = self._get("_metadata", self._load_metadata)
+        self._read()
+        return metadata
+
+    @metadata.setter
+    def metadata(self, value):
+        self._load()
+        self._metadata = value
+        if self.site is not None:
+            self.site.invalidate_queries()
+
+    @property
+    def filtered_content(self):
         """The filtered contents of the item. Should be manipulated by filters. Don't get this directly."""
+        content = self._get("_filtered_content", self._load)
+        self._read()
+        return content
+
+    @filtered_content.setter
+    def filtered_content(self, value):
+        self._load()
+        self._filtered_content = value
+
+    def _get(self, name, load):
+        # Reads an attribute after loading it. Another thread may release the item (see
+        # Compiler.release_items) in between, in which case it's loaded again while holding the lock.
+        load()
+        value = getattr(self, name)
+        if value is None:
+            with self._filter_lock():
+                load()
+                value = getattr(self, name)
+        return value
+
+    def _read(self):
+        # Records a dependency if another item is reading this item while it's being filtered or
+        # templated. See Site.dependencies.
+        if self.site is not None:
+            self.site._record(self.filename)
+
+    @property
+    def source_hash(self):
+        """SHA-1 hash of the item's raw source, including metadata. Used for incremental compilation."""
+        return self._get("_source_hash", self._load)
+
+    def hash_source(self):
+        """Hashes the item's source like :attr:`~Item.source_hash`, but without loading the item if
+        it hasn't been loaded: the source file is hashed in blocks, and the source of a generated item
+        is hashed and dropped. Nothing is kept in memory.
+
+        :returns: SHA-1 hash of the item's raw source"""
+        source_hash = self._source_hash
+        if source_hash is not None:
+            return source_hash
+        if self._source is not None or self.path is None:
+            return hashlib.sha1(_encode(self._read_source())).hexdigest()
+        hash = hashlib.sha1()
+        # Read like _read_source, so that the hash is identical
+        with io.open(self.path, "r") as file:
+            while True:
+                block = file.read(BLOCK_SIZE)
+                if not block:
+                    return hash.hexdigest()
+                hash.update(_encode(block))
 
     def filter(self):
         """Runs all the specified filters on the item. For convenience, returns itself.
@@ -41,29 +260,177 @@ class Item(object):
 
         :returns: self"""
         if self.filtered is False:
-            for filter in self.filters:
-                filter(self)
+            # Items may be filtered from several threads at once (for example when templaters read
+            # other items while compiling with the threads backend)
+            with self._filter_lock():
+                if self.filtered is False:
+                    progress = self._progress
+                    if progress is None:
+                        key = self._filter_cached()
+                        if self.filtered:
+                            return self
+                        start, earlier = 0, ()
+                    else:
+                        # The item is part of a batch that another thread is filtering (see
+                        # filter_items): the remaining filters are run here
+                        start, key, earlier = progress
+                        self._progress = None
 
-        self.filtered = True
+                    with self._rendering() as dependencies:
+                        for filter in self._filters[start:]:
+                            with profiler.measure("filter", profiler.name(filter), self.filename):
+                                if is_batch_filter(filter):
+                                    # Items filtered on their own are batches of one
+                                    filter([self])
+                                else:
+                                    filter(self)
+                    dependencies.update(earlier)
+                    self._filter_done(key, dependencies)
         return self
 
+    def _filter_cached(self):
+        # Fetches the item's filtering result from the site's cache. Returns the result's cache key,
+        # or None if results aren't cached. If a result was found, the item is filtered.
+        cache = getattr(self.site, "cache", None)
+        if cache is None or not self._filters:
+            return None
+        key = self._cache_key(cache, "filter")
+        result = key and self._cached(cache, key)
+        if result:
+            self._filtered_content = result["content"]
+            self._metadata = result["metadata"]
+            self._release_raw()
+            self.filtered = True
+        return key
+
+    def _filter_done(self, key, dependencies):
+        # Caches the result of the item's filters and marks the item as filtered.
+        if key and isinstance(self._filtered_content, basestring):
+            self.site.cache.put(key, {"content": self._filtered_content, "metadata": self._metadata,
+                                      "dependencies": self._dependency_hashes(dependencies)})
+        self._release_raw()
+        self.filtered = True
+
+    def _release_raw(self):
+        # The raw contents aren't needed after filtering. If the filters didn't change them, they're
+        # the filtered contents as well and nothing is released.
+        if self._filtered_content is not self._raw and (self._source is not None or self.path is not None):
+            self._raw = None
+
+    def _rendering(self):
+        # Records the items read by filters and templaters as dependencies of this item.
+        if self.site is None:
+            return _NullRecorder()
+        return self.site._rendering(self.filename)
+
+    def _cached(self, cache, key):
+        # Gets a cached result, unless any of the items it depended on have changed since.
+        result = cache.get(key)
+        if not result:
+            return None
+        for dependency, hash in result["dependencies"].iteritems():
+            if self._dependency_hash(dependency) != hash:
+                return None
+        if result["dependencies"]:
+            self.site._add_dependencies(self.filename, result["dependencies"])
+        return result
+
+    def _dependency_hashes(self, dependencies):
+        hashes = dict((dependency, self._dependency_hash(dependency)) for dependency in dependencies)
+        return dict((dependency, hash) for dependency, hash in hashes.iteritems() if hash is not None)
+
+    def _dependency_hash(self, dependency):
+        # The source hash of an item, or the hash of a membership dependency's members. See
+        # Site.membership.
+        hash = self.site.membership(dependency)
+        if hash is not None:
+            return hash
+        item = self.site.items.get(dependency)
+        return item.source_hash if item is not None else None
+
+    def _cache_key(self, cache, kind):
+        # Generates the key of the item's filter or templater result in a ResultCache. Returns None if
+        # the item's metadata can't be serialized. Filters and templaters may use the item's filename
+        # and route, so items with the same source don't share results.
+        try:
+            metadata = json.dumps(self.metadata, sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+        parts = [kind, self.filename, self.source_hash, metadata] + [callable_identity(filter) for filter in self._filters]
+        if kind == "template":
+            parts.extend([self.file_route or "", callable_identity(self.templater)])
+        return cache.key(*parts)
+
+    def _filter_lock(self):
+        lock = self._lock
+        if lock is None:
+            with _LOCK:
+                if self._lock is None:
+                    self._lock = threading.RLock()
+                lock = self._lock
+        return lock
+
     @property
     def content(self):
         """Generates the item's final, filtered contents.
 
         :returns: contents"""
-        return self.filter().filtered_content
+        # The lock keeps the item from being released between filtering and reading the contents
+        with self._filter_lock():
+            return self.filter().filtered_content
 
     @property
     def templated(self):
         """Generates the item's final, filtered contents templated with the specified :attr:`~Item.templater`.
+        If the templater (or, without a templater, the last filter) produces an iterable of chunks,
+        the iterable is returned as it is. Use :func:`chunks` to consume either kind of result.
 
         :returns: templated contents"""
         # Make sure that the item has been filtered
         self.filter()
+        self._read()
         if self.templater is None:
             return self.content
-        return self.templater(self)
+
+        cache = getattr(self.site, "cache", None)
+        if cache is None or not cache.templates:
+            return self._template()[0]
+
+        key = self._cache_key(cache, "template")
+        result = key and self._cached(cache, key)
+        if result:
+            return result["content"]
+        content, dependencies = self._template()
+        if key and isinstance(content, basestring):
+            cache.put(key, {"content": content, "dependencies": self._dependency_hashes(dependencies)})
+        return content
+
+    def _template(self):
+        # Returns a tuple: (templated contents, keys of the items read by the templater)
+        with self._rendering() as dependencies:
+            with profiler.measure("templater", profiler.name(self.templater), self.filename):
+                content = self.templater(self)
+        if content is not None and not isinstance(content, basestring):
+            content = self._stream(content)
+        return content, dependencies
+
+    def _stream(self, content):
+        # The body of a generator templater only runs when its chunks are consumed (for example by
+        # write_file), so the items read while generating them are recorded and measured then.
+        with self._rendering():
+            with profiler.measure("templater", profiler.name(self.templater), self.filename):
+                for chunk in content:
+                    yield chunk
+
+    @property
+    def signature(self):
+        """Generates a string identifying the item's filters and templater. If any of them changes,
+        the signature changes as well. See :func:`callable_identity`.
+
+        :returns: signature"""
+        parts = [callable_identity(filter) for filter in self._filters]
+        parts.append(callable_identity(self.templater))
+        return hashlib.sha1("\n".join(parts)).hexdigest()
 
     @property
     def route(self):
@@ -71,4 +438,314 @@ class Item(object):
         end of paths for cleaner URL's.
 
         :returns: URL"""
-        return self.file_route.replace("/index.html", "/")
\ No newline at end of file
+        return self.file_route.replace("/index.html", "/")
+
+class _FilterList(list):
+    # A copy of an item's shared filter tuple that writes changes back to the item.
+
+    __slots__ = ("_item",)
+
+    def __init__(self, item):
+        super(_FilterList, self).__init__(item._filters)
+        self._item = item
+
+def _writes_back(name):
+    method = getattr(list, name)
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._item.filters = self
+        return result
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ("append", "extend", "insert", "remove", "pop", "reverse", "sort", "__setitem__", "__delitem__",
+              "__setslice__", "__delslice__", "__iadd__", "__imul__"):
+    setattr(_FilterList, _name, _writes_back(_name))
+
+def batch_filter(filter):
+    """Marks a filter as a batch filter: instead of a single item, the filter receives a list of
+    items and filters them together. Filters with a high setup cost per call, like syntax
+    highlighters, external programs or spell checkers, can then pay the cost once per batch.
+
+    Batch filters are added like other filters, and they run in their place in the items' filters:
+    the filters before them have run on every item of the batch and the filters after them haven't.
+    The compiler batches the items that have the same filters (see :func:`filter_items`). Items that
+    are filtered on their own, for example when another item reads them, are passed to the filter as
+    batches of one.
+
+    :param filter: a callable object that takes a list of items as an argument
+    :returns: the filter"""
+    filter.batch = True
+    return filter
+
+def is_batch_filter(filter):
+    """Checks if a filter is a batch filter. See :func:`batch_filter`.
+
+    :param filter: the filter
+    :returns: ``True`` if the filter takes a list of items"""
+    return getattr(filter, "batch", False) is True
+
+def filter_items(items, size=256):
+    """Filters items in batches: items that have the same filters and include a batch filter (see
+    :func:`batch_filter`) are grouped together and each batch filter is called once per group of up
+    to ``size`` items. The other filters are called for each item in order. Items that have already
+    been filtered, have no batch filters or whose results are found in :attr:`Site.cache` are
+    filtered as usual.
+
+    Items read by a batch filter are recorded as dependencies of every item in the batch (see
+    :attr:`Site.dependencies`).
+
+    If a batch fails, the other batches are still filtered before the first error is raised. The
+    items of the failed batch are left unfiltered.
+
+    :param items: list of items
+    :param size: the maximum number of items in a batch"""
+    groups = {}
+    order = []
+    for item in items:
+        if item.filtered or item.passthrough or not any(is_batch_filter(filter) for filter in item._filters):
+            continue
+        try:
+            group = groups.get(item._filters)
+        except TypeError:
+            # Unhashable filters can't be grouped
+            group = None
+            chain = len(order)
+        else:
+            chain = item._filters
+        if group is None:
+            group = groups[chain] = []
+            order.append(chain)
+        group.append(item)
+
+    error = None
+    for chain in order:
+        group = groups[chain]
+        for start in range(0, len(group), size):
+            try:
+                _filter_batch(group[start:start + size])
+            except Exception:
+                if error is None:
+                    error = sys.exc_info()
+    if error is not None:
+        raise error[0], error[1], error[2]
+
+def _filter_batch(items):
+    # Runs the filters of items that share them, calling batch filters once for all of them. Items are
+    # only locked while a filter runs on them (the whole batch, in a consistent order, for batch
+    # filters), so that their filters may read items of other batches. The step each item has reached
+    # is kept in its _progress: if another thread needs the item in the meantime, Item.filter runs
+    # the remaining filters and the batch skips the item.
+    pending = []
+    for item in sorted(set(items), key=lambda item: item.filename):
+        with item._filter_lock():
+            if item.filtered is False and item._progress is None:
+                key = item._filter_cached()
+                if not item.filtered:
+                    progress = item._progress = [0, key, set()]
+                    pending.append((item, progress))
+    if not pending:
+        return
+
+    site = pending[0][0].site
+    names = set(item.filename for item, progress in pending)
+    try:
+        for step, filter in enumerate(pending[0][0]._filters):
+            name = profiler.name(filter)
+            if is_batch_filter(filter):
+                locks = [item._filter_lock() for item, progress in pending]
+                for lock in locks:
+                    lock.acquire()
+                try:
+                    batch = [(item, progress) for item, progress in pending if _at_step(item, progress, step)]
+                    if not batch:
+                        continue
+                    with site._rendering(None) if site is not None else _NullRecorder() as read:
+                        with profiler.measure("filter", name):
+                            filter([item for item, progress in batch])
+                    read -= names
+                    for item, progress in batch:
+                        progress[0] += 1
+                        progress[2].update(read)
+                        if site is not None and read:
+                            site._add_dependencies(item.filename, read)
+                finally:
+                    for lock in reversed(locks):
+                        lock.release()
+                continue
+            for item, progress in pending:
+                with item._filter_lock():
+                    if not _at_step(item, progress, step):
+                        continue
+                    with item._rendering() as read:
+                        with profiler.measure("filter", name, item.filename):
+                            filter(item)
+                    progress[0] += 1
+                    progress[2].update(read)
+
+        for item, progress in pending:
+            with item._filter_lock():
+                if _at_step(item, progress, len(item._filters)):
+                    item._progress = None
+                    item._filter_done(progress[1], progress[2])
+    except:
+        # Partially filtered items are filtered again on their own
+        for item, progress in pending:
+            with item._filter_lock():
+                if item._progress is progress:
+                    item._progress = None
+                    if not item.filtered and item._source_hash is not None:
+                        item._filtered_content = item._raw
+        raise
+
+def _at_step(item, progress, step):
+    # Checks if an item is still being filtered by a batch and has reached a step of its filters.
+    return item._progress is progress and progress[0] == step
+
+def callable_identity(obj, _seen=None):
+    """Generates a string identifying a filter, templater or router. The identity consists of the
+    callable's module and name, a hash of its code, default arguments and closure and the value of its
+    ``version`` attribute (if any). ``functools.partial`` objects are identified by their function and
+    arguments, and bound methods by their function. Set a ``version`` attribute on a callable to force
+    a rebuild when something it depends on (for example a template file) changes.
+
+    :param obj: callable or ``None``
+    :returns: identity string"""
+    if obj is None:
+        return "None"
+    # Guards against functions whose closure refers to themselves
+    seen = _seen if _seen is not None else set()
+    if id(obj) in seen:
+        return "recursive"
+    seen.add(id(obj))
+
+    version = getattr(obj, "version", None)
+    if isinstance(obj, functools.partial):
+        parts = ["partial", callable_identity(obj.func, seen)]
+        parts.extend(_value_identity(arg, seen) for arg in obj.args)
+        parts.extend("{}={}".format(name, _value_identity(value, seen))
+                     for name, value in sorted((obj.keywords or {}).iteritems()))
+    else:
+        obj = getattr(obj, "__func__", obj)
+        name = getattr(obj, "__name__", type(obj).__name__)
+        parts = [getattr(obj, "__module__", None) or "", name]
+        code = getattr(obj, "__code__", None)
+        if code is not None:
+            parts.append(_code_hash(code))
+            parts.extend(_value_identity(value, seen) for value in obj.__defaults__ or ())
+            for cell in obj.__closure__ or ():
+                try:
+                    parts.append(_value_identity(cell.cell_contents, seen))
+                except ValueError:
+                    # The variable hasn't been assigned yet
+                    parts.append("empty")
+    if version is not None:
+        parts.append(str(version))
+    return ":".join(parts)
+
+def _value_identity(value, seen):
+    # Identifies a default argument, closure variable or partial argument. Callables are identified
+    # by their code, and objects whose repr contains their memory address by their type, since the
+    # address changes from run to run.
+    if isinstance(value, functools.partial) or hasattr(value, "__code__") or hasattr(value, "__func__"):
+        return callable_identity(value, seen)
+    text = repr(value)
+    if " at 0x" in text:
+        return "{}.{}".format(type(value).__module__, type(value).__name__)
+    return text
+
+class _NullRecorder(object):
+
+    def __enter__(self):
+        return set()
+
+    def __exit__(self, *args):
+        return False
+
+def _code_hash(code):
+    # Nested code objects (lambdas, inner functions) have a repr containing their memory address,
+    # so they're hashed recursively instead.
+    hash = hashlib.sha1(code.co_code)
+    # The names of attributes, globals and variables the code uses aren't part of co_code
+    for names in (code.co_names, code.co_varnames, code.co_freevars, code.co_cellvars):
+        hash.update(repr(names))
+    for const in code.co_consts:
+        if hasattr(const, "co_code"):
+            hash.update(_code_hash(const))
+        else:
+            hash.update(repr(const))
+    return hash.hexdigest()
+
+def split_front_matter(text):
+    """Splits an item's source into metadata and body. The metadata is a JSON object between two
+    lines of three dashes at the beginning of the source (see :data:`MATCHER`). Only the metadata
+    block is scanned, and the body is returned as an offset instead of a copy.
+
+    :param text: the item's source
+    :returns: tuple: (metadata string or ``None`` if there's no metadata, offset of the body)"""
+    if not text.startswith("---"):
+        return None, 0
+    # The opening delimiter is followed by whitespace that includes a line break. The metadata starts
+    # on the line after the last line break.
+    end = _skip_whitespace(text, 3)
+    start = text.rfind("\n", 3, end) + 1
+    if start == 0:
+        return None, 0
+
+    position = start
+    while True:
+        closing = text.find("---", position)
+        if closing < 0:
+            return None, 0
+        # The closing delimiter has to be preceded by a line break and nothing but whitespace
+        first = closing
+        while first > start and text[first - 1] in WHITESPACE:
+            first -= 1
+        line_break = text.find("\n", first, closing)
+        if line_break > start:
+            return text[start:line_break], _skip_whitespace(text, closing + 3)
+        position = closing + 1
+
+def read_metadata(path):
+    """Reads the metadata of an item from its source file without reading the rest of the file.
+
+    :param path: path to the item's source file
+    :returns: metadata dictionary"""
+    lines = []
+    with io.open(path, "r") as file:
+        for line in file:
+            if not lines and not line.startswith("---"):
+                return {}
+            lines.append(line)
+            # Only lines starting with a delimiter can end the metadata block
+            if len(lines) > 1 and line.lstrip().startswith("---"):
+                metadata, offset = split_front_matter(u"".join(lines))
+                if metadata is not None:
+                    return json.loads(metadata)
+    metadata, offset = split_front_matter(u"".join(lines))
+    return json.loads(metadata) if metadata is not None else {}
+
+def _skip_whitespace(text, position):
+    length = len(text)
+    while position < length and text[position] in WHITESPACE:
+        position += 1
+    return position
+
+def chunks(content):
+    """Iterates over contents as UTF-8 encoded byte strings. Filters and templaters may produce either
+    a string or an iterable of strings (for example a generator), which lets very large outputs be
+    written without holding all of them in memory. See :func:`~vasara.compiler.write_file`.
+
+    :param content: a string or an iterable of strings
+    :returns: iterator of byte strings"""
+    if isinstance(content, basestring):
+        yield _encode(content)
+        return
+    for chunk in content:
+        if chunk:
+            yield _encode(chunk)
+
+def _encode(text):
+    if isinstance(text, unicode):
+        return text.encode("utf-8")
+    return text
@@ -0,0 +1,91 @@
+import gzip
+import io
+import re
+import subprocess
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Elements whose contents are left as they are by minify_html
+PRESERVED = re.compile(r"(<(pre|textarea|script|style)\b.*?</\2\s*>)", re.I | re.S)
+
+HTML_COMMENT = re.compile(r"<!--(?!\[if).*?-->", re.S)
+
+# Strings and comments in CSS. Strings are kept as they are, comments are removed.
+CSS_TOKEN = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|/\*.*?\*/""", re.S)
+
+def minify_html(data):
+    """Removes comments (except conditional comments) and collapses whitespace in HTML. The contents
+    of ``pre``, ``textarea``, ``script`` and ``style`` elements are left as they are. Whitespace is
+    collapsed to a single character rather than removed, so inline elements are laid out as before.
+
+    :param data: the HTML as a byte string
+    :returns: the minified HTML"""
+    parts = PRESERVED.split(data)
+    result = []
+    # split() returns the text between the preserved elements, each element and its tag name
+    for index in range(0, len(parts), 3):
+        text = HTML_COMMENT.sub("", parts[index])
+        result.append(re.sub(r"\s+", lambda match: "\n" if "\n" in match.group(0) else " ", text))
+        if index + 1 < len(parts):
+            result.append(parts[index + 1])
+    return "".join(result).strip()
+
+def minify_css(data):
+    """Removes comments and unnecessary whitespace from CSS. Strings are left as they are.
+
+    :param data: the CSS as a byte string
+    :returns: the minified CSS"""
+    result = []
+    position = 0
+    for match in CSS_TOKEN.finditer(data):
+        result.append(_minify_css_code(data[position:match.start()]))
+        if match.group(1):
+            result.append(match.group(1))
+        position = match.end()
+    result.append(_minify_css_code(data[position:]))
+    return "".join(result).strip()
+
+def _minify_css_code(code):
+    code = re.sub(r"\s+", " ", code)
+    code = re.sub(r" ?([{};,>]) ?", r"\1", code)
+    # A space before a colon is significant in selectors ("a :hover")
+    code = code.replace(": ", ":")
+    return code.replace(";}", "}")
+
+def external(command):
+    """Creates a post-processor that pipes the output through an external program, for example a
+    JavaScript minifier.
+
+    :param command: the program and its arguments as a list
+    :returns: post-processor"""
+    def processor(data):
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = process.communicate(data)
+        if process.returncode != 0:
+            raise RuntimeError("{} failed with exit code {}: {}".format(command[0], process.returncode, errors))
+        return output
+    processor.__name__ = "external({})".format(" ".join(command))
+    processor.version = " ".join(command)
+    return processor
+
+def compress_gzip(data):
+    # The modification time is left out so that unchanged content compresses identically.
+    buffer = io.BytesIO()
+    with gzip.GzipFile(filename="", mode="wb", fileobj=buffer, compresslevel=9, mtime=0) as file:
+        file.write(data)
+    return buffer.getvalue()
+
+def compress_brotli(data):
+    return brotli.compress(data)
+
+COMPRESSORS = {"gzip": (".gz", compress_gzip)}
+"""Available precompression formats: {format: (file suffix, compression function)}. ``br`` requires
+the ``brotli`` package."""
+if brotli is not None:
+    COMPRESSORS["br"] = (".br", compress_brotli)
+
+SUFFIXES = (".gz", ".br")
+"""Suffixes of the precompressed variants of outputs."""
@@ -0,0 +1,215 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+cpu_time = getattr(time, "process_time", time.clock)
+
+class Profiler(object):
+    """Collects wall time, CPU time and call counts of build stages, filters and templaters. Stages
+    are identified by a category (for example ``filter``) and a name (for example the filter's
+    name). Use :func:`enable` to install a profiler; vasara measures its stages with :func:`measure`.
+
+    CPU time is measured for the whole process, so it includes other threads' work when compiling
+    with the ``threads`` backend."""
+
+    def __init__(self, trace=False):
+        """Constructor.
+
+        :param trace: if ``True``, every measurement is kept for :meth:`~Profiler.chrome_trace`"""
+        self.trace = trace
+        """Specifies if every measurement is kept."""
+        self.stages = {}
+        """Measurements by stage: {(category, name): [calls, wall time, CPU time]}"""
+        self.items = {}
+        """Total build wall time by item key."""
+        self.events = []
+        """Every measurement if :attr:`~Profiler.trace` is enabled: [(category, name, item, start, duration, thread)]"""
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, category, name, item=None):
+        """A context manager that measures the code inside it.
+
+        :param category: the stage's category
+        :param name: the stage's name
+        :param item: key of the item being processed (optional)"""
+        wall = time.time()
+        cpu = cpu_time()
+        try:
+            yield
+        finally:
+            self.add(category, name, item, wall, time.time() - wall, cpu_time() - cpu)
+
+    def add(self, category, name, item, start, wall, cpu, calls=1, thread=None):
+        """Records a measurement.
+
+        :param category: the stage's category
+        :param name: the stage's name
+        :param item: key of the item being processed or ``None``
+        :param start: start time of the measurement
+        :param wall: wall time in seconds
+        :param cpu: CPU time in seconds
+        :param calls: the number of calls measured"""
+        with self._lock:
+            stage = self.stages.setdefault((category, name), [0, 0.0, 0.0])
+            stage[0] += calls
+            stage[1] += wall
+            stage[2] += cpu
+            if item is not None and category == "compiler" and name == "build":
+                self.items[item] = self.items.get(item, 0.0) + wall
+            if self.trace:
+                thread = thread if thread is not None else "{}:{}".format(os.getpid(), threading.current_thread().ident)
+                self.events.append((category, name, item, start, wall, thread))
+
+    def clear(self):
+        """Removes all measurements."""
+        with self._lock:
+            self.stages = {}
+            self.items = {}
+            self.events = []
+
+    def data(self):
+        """Returns all measurements in a form that can be passed to :meth:`~Profiler.merge` (for
+        example from a worker process)."""
+        with self._lock:
+            return dict(self.stages), dict(self.items), list(self.events)
+
+    def merge(self, data):
+        """Adds measurements returned by another profiler's :meth:`~Profiler.data`."""
+        stages, items, events = data
+        with self._lock:
+            for key, (calls, wall, cpu) in stages.iteritems():
+                stage = self.stages.setdefault(key, [0, 0.0, 0.0])
+                stage[0] += calls
+                stage[1] += wall
+                stage[2] += cpu
+            for key, wall in items.iteritems():
+                self.items[key] = self.items.get(key, 0.0) + wall
+            if self.trace:
+                self.events.extend(events)
+
+    def report(self, slowest=20):
+        """Generates a report of the measurements.
+
+        :param slowest: the number of slowest items to include
+        :returns: a JSON serializable dictionary"""
+        stages = [{"category": category, "name": name, "calls": calls, "wall": wall, "cpu": cpu}
+                  for (category, name), (calls, wall, cpu) in self.stages.iteritems()]
+        stages.sort(key=lambda stage: stage["wall"], reverse=True)
+        items = sorted(self.items.iteritems(), key=lambda pair: pair[1], reverse=True)[:slowest]
+        return {
+            "total": time.time() - self.start,
+            "peak_rss": peak_rss(),
+            "stages": stages,
+            "slowest_items": [{"item": key, "wall": wall} for key, wall in items],
+        }
+
+    def chrome_trace(self):
+        """Generates the measurements in the Chrome trace event format (for ``chrome://tracing``).
+        Requires :attr:`~Profiler.trace`.
+
+        :returns: a JSON serializable dictionary"""
+        events = []
+        for category, name, item, start, duration, thread in self.events:
+            pid, tid = thread.split(":")
+            event = {
+                "name": name, "cat": category, "ph": "X",
+                "ts": int((start - self.start) * 1000000), "dur": int(duration * 1000000),
+                "pid": int(pid), "tid": int(tid),
+            }
+            if item is not None:
+                event["args"] = {"item": item}
+            events.append(event)
+        return {"traceEvents": events}
+
+    def summary(self, stages=15, slowest=10):
+        """Generates a human readable summary of the measurements.
+
+        :returns: list of lines"""
+        report = self.report(slowest=slowest)
+        lines = []
+        if report["peak_rss"] is not None:
+            lines.extend(["Peak memory usage: {:.1f} MB".format(report["peak_rss"] / 1024.0 / 1024.0), ""])
+        lines.append("{:<50} {:>8} {:>10} {:>10}".format("Stage", "Calls", "Wall (s)", "CPU (s)"))
+        for stage in report["stages"][:stages]:
+            lines.append("{:<50} {:>8} {:>10.3f} {:>10.3f}".format(
+                "{}: {}".format(stage["category"], stage["name"])[:50], stage["calls"], stage["wall"], stage["cpu"]))
+        if report["slowest_items"]:
+            lines.append("")
+            lines.append("Slowest items:")
+            for item in report["slowest_items"]:
+                lines.append("  {:<56} {:>10.3f}".format(item["item"], item["wall"]))
+        return lines
+
+    def save(self, path, format="json"):
+        """Writes the measurements to a file.
+
+        :param path: path to the file
+        :param format: ``json`` for :meth:`~Profiler.report` or ``chrome`` for :meth:`~Profiler.chrome_trace`"""
+        data = self.chrome_trace() if format == "chrome" else self.report()
+        with open(path, "wb") as file:
+            json.dump(data, file, indent=2)
+
+_active = None
+
+class _NullContext(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL = _NullContext()
+
+def enable(trace=False):
+    """Installs a new :class:`Profiler` that will receive all measurements.
+
+    :param trace: see :attr:`Profiler.trace`
+    :returns: the profiler"""
+    global _active
+    _active = Profiler(trace=trace)
+    return _active
+
+def disable():
+    """Removes the installed profiler."""
+    global _active
+    _active = None
+
+def active():
+    """Returns the installed :class:`Profiler` or ``None``."""
+    return _active
+
+def measure(category, name, item=None):
+    """Measures the code inside a ``with`` block if a profiler has been installed. Does nothing
+    otherwise.
+
+    :param category: the stage's category
+    :param name: the stage's name
+    :param item: key of the item being processed (optional)"""
+    if _active is None:
+        return _NULL
+    return _active.measure(category, name, item)
+
+def peak_rss():
+    """Returns the peak resident set size of this process or of its largest child process (for
+    example a worker of the ``processes`` backend) in bytes, or ``None`` if it can't be measured
+    on the platform."""
+    if resource is None:
+        return None
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux reports kilobytes, OS X bytes
+    return usage if sys.platform == "darwin" else usage * 1024
+
+def name(obj):
+    """Generates a readable name for a filter or templater."""
+    return "{}.{}".format(getattr(obj, "__module__", None) or "?", getattr(obj, "__name__", type(obj).__name__))
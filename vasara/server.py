@@ -0,0 +1,235 @@
+import BaseHTTPServer
+import collections
+import hashlib
+import io
+import mimetypes
+import os
+import posixpath
+import shutil
+import threading
+import traceback
+import urllib
+import urlparse
+
+from vasara.item import chunks
+from vasara.site import is_membership
+
+class ResponseCache(object):
+    """A least recently used cache of rendered responses by route."""
+
+    def __init__(self, size=256):
+        self.size = size
+        """The maximum number of cached responses."""
+        self._responses = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, route):
+        """Gets a cached response and marks it as recently used.
+
+        :param route: the response's route
+        :returns: tuple: (item key, body, etag) or ``None``"""
+        with self._lock:
+            response = self._responses.pop(route, None)
+            if response is not None:
+                self._responses[route] = response
+            return response
+
+    def put(self, route, key, body):
+        """Caches a response, evicting the least recently used responses if the cache is full.
+
+        :param route: the response's route
+        :param key: the key of the item that produced the response
+        :param body: the response body
+        :returns: the response's etag"""
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        with self._lock:
+            self._responses.pop(route, None)
+            self._responses[route] = (key, body, etag)
+            while len(self._responses) > self.size:
+                self._responses.popitem(last=False)
+        return etag
+
+    def invalidate(self, keys):
+        """Removes the responses produced by the specified items.
+
+        :param keys: list of item keys"""
+        keys = set(keys)
+        with self._lock:
+            for route, (key, body, etag) in self._responses.items():
+                if key in keys:
+                    del self._responses[route]
+
+class Server(object):
+    """A development server that renders items on demand straight from the :class:`Site` in memory,
+    without compiling the site to disk first."""
+
+    def __init__(self, site, listen="127.0.0.1", port=8000, cache_size=256):
+        """Constructor.
+
+        :param site: the site to serve
+        :param listen: the address to listen on
+        :param port: the port to listen on
+        :param cache_size: the maximum number of rendered responses to cache"""
+        self.site = site
+        self.cache = ResponseCache(cache_size)
+        """The :class:`ResponseCache` of rendered responses."""
+        self.lock = threading.RLock()
+        """Held while rendering items and while updating the site."""
+        self._routes = None
+        self._routes_version = None
+
+        self.httpd = BaseHTTPServer.HTTPServer((listen, port), RequestHandler)
+        """The underlying ``HTTPServer``."""
+        self.httpd.vasara_server = self
+
+    def find(self, path):
+        """Finds the item that is routed to an URL path. Paths ending with a slash (or not matching any
+        route) are looked up with ``index.html`` appended.
+
+        :param path: the URL path
+        :returns: tuple: (route, item) or (``None``, ``None``) if no item is routed to the path"""
+        route = posixpath.normpath(urllib.unquote(path)).lstrip("/")
+        if route == ".":
+            route = ""
+        if path.endswith("/") or not route:
+            route = posixpath.join(route, "index.html")
+
+        with self.lock:
+            routes = self._route_map()
+            key = routes.get(route)
+            if key is None and not path.endswith("/"):
+                # Directory routes without the trailing slash
+                route = posixpath.join(route, "index.html")
+                key = routes.get(route)
+            if key is None:
+                return None, None
+            return route, self.site.items[key]
+
+    def render(self, route, item):
+        """Renders an item, using the cache if possible. Passthrough items aren't rendered or cached:
+        use :meth:`~Server.passthrough_etag` and read the source file instead.
+
+        :param route: the item's route
+        :param item: the item
+        :returns: tuple: (body, etag)"""
+        cached = self.cache.get(route)
+        if cached is not None:
+            return cached[1], cached[2]
+
+        with self.lock:
+            body = "".join(chunks(item.templated))
+        return body, self.cache.put(route, item.filename, body)
+
+    def passthrough_etag(self, item):
+        """Generates an etag for a passthrough item from its source file's size and modification time.
+
+        :param item: the item
+        :returns: etag"""
+        stat = os.stat(item.path)
+        return '"{}-{}"'.format(stat.st_size, stat.st_mtime)
+
+    def update(self, paths):
+        """Updates the site after files have changed and invalidates the affected responses, including
+        the responses of items that depend on the changed items (see :attr:`Site.dependencies`) and
+        of items whose listings or queries find different items now (see :meth:`Site.membership`).
+
+        :param paths: list of changed absolute paths (see :meth:`Site.rescan`)
+        :returns: tuple of lists: (changed and new item keys, removed item keys)"""
+        with self.lock:
+            memberships = set(dependency for dependencies in self.site.dependencies.itervalues()
+                              for dependency in dependencies if is_membership(dependency))
+            before = dict((dependency, self.site.membership(dependency)) for dependency in memberships)
+            changed, removed = self.site.rescan(paths)
+            # Items that read the changed items have to be rendered again as well
+            dependents = self.site.dependents(changed + removed)
+            stale = set(dependency for dependency in memberships if self.site.membership(dependency) != before[dependency])
+            if stale:
+                listings = [key for key, dependencies in self.site.dependencies.iteritems() if dependencies & stale]
+                dependents.update(listings)
+                dependents.update(self.site.dependents(listings))
+            for key in dependents:
+                if key in self.site.items:
+                    self.site.items[key].unload()
+            # Routes may change when items change
+            self._routes = None
+        self.cache.invalidate(changed + removed + list(dependents))
+        return changed, removed
+
+    def watch(self, interval=1.0, debounce=0.1):
+        """Starts a background thread that watches the site's items for changes.
+
+        :param interval: polling interval when inotify isn't available
+        :param debounce: time to wait for more changes before updating"""
+        from vasara.watcher import create_watcher
+        watcher = create_watcher(self.site.items_path, interval=interval)
+
+        def run():
+            while True:
+                self.update(watcher.changes(debounce=debounce))
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def serve_forever(self):
+        """Handles requests until interrupted."""
+        self.httpd.serve_forever()
+
+    def _route_map(self):
+        # Maps routes to item keys. Rebuilt when items are added or removed.
+        version = getattr(self.site.items, "version", None)
+        if self._routes is None or version is None or version != self._routes_version:
+            self._routes = dict((item.file_route, key) for key, item in self.site.items.iteritems()
+                                if item.file_route is not None)
+            self._routes_version = version
+        return self._routes
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def respond(self, send_body):
+        server = self.server.vasara_server
+        route, item = server.find(urlparse.urlsplit(self.path).path)
+        if item is None:
+            self.send_error(404)
+            return
+
+        try:
+            if item.passthrough:
+                body = None
+                etag = server.passthrough_etag(item)
+            else:
+                body, etag = server.render(route, item)
+        except Exception as e:
+            self.log_error("%s", traceback.format_exc())
+            self.send_error(500, "Item {} failed to render: {}".format(item.filename, e))
+            return
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", mimetypes.guess_type(route)[0] or "application/octet-stream")
+        self.send_header("ETag", etag)
+
+        if body is None:
+            # Passthrough items are streamed from their source files
+            with io.open(item.path, "rb") as file:
+                self.send_header("Content-Length", str(os.fstat(file.fileno()).st_size))
+                self.end_headers()
+                if send_body:
+                    shutil.copyfileobj(file, self.wfile)
+            return
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
@@ -1,37 +1,639 @@
-import os
+import bisect
+import fnmatch
+import hashlib
 import io
+import json
+import os
 import re
 import sys
+import threading
+import time
+from contextlib import contextmanager
+from vasara import profiler
 from vasara.item import Item
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+DEFAULT_IGNORE = (".git", ".hg", ".svn", ".DS_Store", "*.swp", "*.swo", "*~", ".#*", "#*#")
+"""Ignore patterns for version control directories and editor temporary files. See :attr:`Site.ignore`."""
+
+# Characters that end the literal prefix of a regular expression
+SPECIAL = ".^$*+?{}[]()|\\"
+
+# Matches expressions like ".*\.html$" that only match items with a specific extension
+EXTENSION = re.compile(r"\A\(?\.\*\)?\\\.\(?([A-Za-z0-9_]+)\)?(?:\$|\\Z)\Z")
+
+SNAPSHOT_VERSION = 1
+
+# Directories modified this close to the time their listing was saved may have changed again within
+# the resolution of their modification time, so they're listed again
+SNAPSHOT_MARGIN = 2.0
+
+# Membership dependencies (see Site.membership) start with a character that item keys can't contain
+MEMBERSHIP = "\0"
+
+# The membership dependency of filters and templaters that list all the items
+ALL_ITEMS = MEMBERSHIP + "*"
+
+class ItemDict(dict):
+    """A dictionary of items that keeps track of changes to its keys with a version number. Listing
+    the items while an item is being filtered or templated records a membership dependency on all
+    of them (see :meth:`Site.membership`)."""
+
+    def __init__(self, *args, **kwargs):
+        super(ItemDict, self).__init__(*args, **kwargs)
+        self.version = 0
+        """Incremented whenever an item is added, replaced or removed."""
+        self.site = None
+        """The site whose items these are, or ``None``."""
+
+    def _listed(self):
+        if self.site is not None:
+            self.site._record(ALL_ITEMS)
+
+    def __iter__(self):
+        self._listed()
+        return super(ItemDict, self).__iter__()
+
+    def __len__(self):
+        self._listed()
+        return super(ItemDict, self).__len__()
+
+    def keys(self):
+        self._listed()
+        return super(ItemDict, self).keys()
+
+    def values(self):
+        self._listed()
+        return super(ItemDict, self).values()
+
+    def items(self):
+        self._listed()
+        return super(ItemDict, self).items()
+
+    def iterkeys(self):
+        self._listed()
+        return super(ItemDict, self).iterkeys()
+
+    def itervalues(self):
+        self._listed()
+        return super(ItemDict, self).itervalues()
+
+    def iteritems(self):
+        self._listed()
+        return super(ItemDict, self).iteritems()
+
+    def __setitem__(self, key, value):
+        super(ItemDict, self).__setitem__(key, value)
+        self.version += 1
+
+    def __delitem__(self, key):
+        super(ItemDict, self).__delitem__(key)
+        self.version += 1
+
+    def clear(self):
+        super(ItemDict, self).clear()
+        self.version += 1
+
+    def pop(self, *args):
+        self.version += 1
+        return super(ItemDict, self).pop(*args)
+
+    def popitem(self):
+        self.version += 1
+        return super(ItemDict, self).popitem()
+
+    def setdefault(self, key, default=None):
+        self.version += 1
+        return super(ItemDict, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        super(ItemDict, self).update(*args, **kwargs)
+        self.version += 1
+
 class Site(object):
 
-    def __init__(self, base_path, items_path):
-        """Constructor.
+    def __init__(self, base_path, items_path, defer_rules=False, cache=None, ignore=None, workers=1, preload=False,
+                 snapshot_path=None):
+        """Constructor. The items path is scanned when :attr:`~Site.items` is first used.
 
         :param base_path: absolute base path for site
-        :param items_path: absolute path to site items"""
+        :param items_path: absolute path to site items
+        :param defer_rules: if ``True``, routes, filters and templaters are only recorded until
+                            :meth:`~Site.apply_rules` is called
+        :param cache: a :class:`~vasara.cache.ResultCache` for filter and templater results
+        :param ignore: list of filename patterns to ignore (see :attr:`~Site.ignore`)
+        :param workers: the number of threads used for scanning and preloading items
+        :param preload: if ``True``, the site is scanned and all items are read and parsed right
+                        away, using ``workers`` threads (see :meth:`~Site.preload`)
+        :param snapshot_path: path to a file for caching the directory listings of the items path
+                              (see :attr:`~Site.snapshot_path`)"""
 
         self.base_path = base_path
         self.items_path = items_path
-        self.items = {}
-        """A dictioanry of the site's items."""
-        self.scan()
+        self._items = None
+        self.rules = []
+        """A list of all the rules registered with :meth:`~Site.route`, :meth:`~Site.filter`,
+        :meth:`~Site.template` and :meth:`~Site.passthrough` as tuples: [(kind, expression, callable)]"""
+        self.defer_rules = defer_rules
+        """If ``True``, rules are only recorded until :meth:`~Site.apply_rules` is called."""
+        self.cache = cache
+        """A :class:`~vasara.cache.ResultCache` for filter and templater results, or ``None``."""
+        self.ignore = ignore or ()
+        """A list of shell-style patterns (for example ``.git`` or ``*.swp``) matched against file and
+        directory names. Matching files are not added as items, and matching directories are never
+        walked. See :data:`DEFAULT_IGNORE`."""
+        self.workers = workers
+        """The number of threads used for scanning and preloading items."""
+        self.snapshot_path = snapshot_path
+        """Path to a file where :meth:`~Site.scan` saves the directory listings of the items path, or
+        ``None``. The next scan only lists the directories whose modification times have changed since.
+        Every file is still checked for changes, but listing unchanged directories is skipped."""
+        self.generators = []
+        """Callables that generate virtual items. See :meth:`~Site.generate`."""
+        self.dependencies = {}
+        """Dependencies between items, recorded while filtering and templating: when a filter or
+        templater of an item reads another item's metadata or contents, the other item is recorded as a
+        dependency. Listing the items or querying them records a membership dependency as well (see
+        :meth:`~Site.membership`). A dictionary of sets of item keys by item key."""
+        self._local = threading.local()
+        self._chains = {}
+        self._query_indexes = {}
+        self._query_version = None
+        self._metadata_version = 0
+        self._ignore = re.compile("|".join(fnmatch.translate(pattern) for pattern in self.ignore)) if self.ignore else None
+        self._scan_lock = threading.Lock()
+        self._generated = set()
+        self._snapshot = None
+        if preload:
+            self.preload()
+
+    @property
+    def items(self):
+        """A dictionary of the site's items. The items path is scanned when this is first used."""
+        if self._items is None:
+            with self._scan_lock:
+                if self._items is None:
+                    self.scan()
+        return self._items
 
+    @items.setter
+    def items(self, value):
+        self._items = value
 
     def scan(self):
-        """Scans the site's items path for items."""
-        path = os.path.abspath(self.items_path)
-        for dirpath, dirnames, filenames in os.walk(path):
-            for file in filenames:
-                full = os.path.abspath(os.path.join(dirpath, file))
-                key = full[len(path):][1:]
+        """Scans the site's items path for items. Items are loaded lazily: only their paths and
+        file information are read here, the contents are read when first needed."""
+        with profiler.measure("site", "scan"):
+            if self._items is None:
+                self._items = ItemDict()
+                self._items.site = self
+            root = os.path.abspath(self.items_path)
+            self._snapshot = (self._load_snapshot(root), {}) if self.snapshot_path is not None else None
+            try:
+                for key, full, stat in self._walk(root):
+                    self._items[key] = Item(filename=key, site=self, path=full, size=stat.st_size, mtime=stat.st_mtime)
+                if self._snapshot is not None:
+                    self._save_snapshot(root, self._snapshot[1])
+            finally:
+                self._snapshot = None
+        if self.generators:
+            self._generate()
+
+    def generate(self, generator):
+        """Registers a callable that generates virtual items: items without a source file, for
+        example paginated archives or tag pages. Virtual items are routed, filtered, templated and
+        compiled like any other items.
+
+        The generator is called with the site after the items path has been scanned (or right away if
+        it already has been) and whenever :meth:`~Site.rescan` finds changes. It should yield tuples:
+        ``(key, source)``. The source is the item's raw contents, including metadata, or a callable
+        that returns them. Callables are only called when the item is needed, and again after it has
+        been unloaded, so the contents of virtual items don't have to be kept in memory. Sources are
+        best kept small (for example the tag and page number as metadata), with the templater doing
+        the rest, since reads of other items are only recorded as dependencies in filters and
+        templaters.
+
+        :param generator: a callable that takes the site as an argument and yields tuples:
+                          ``(key, source)``
+        :raises: ``ValueError`` if a generated key is already used by a scanned item"""
+        self.generators.append(generator)
+        if self._items is not None:
+            try:
+                self._generate()
+            except:
+                self.generators.remove(generator)
+                raise
+
+    def _generate(self):
+        # Runs the generators and replaces the previously generated items with the new ones, applying
+        # the recorded rules to them. Returns a tuple of lists: (generated keys, keys no longer
+        # generated).
+        with profiler.measure("site", "generate"):
+            # The generators may query the site, so nothing is changed until they have all finished
+            generated = []
+            for generator in self.generators:
+                generated.extend(generator(self))
+
+            keys = set()
+            for key, source in generated:
+                if key in self.items and key not in self._generated or key in keys:
+                    raise ValueError("Generated item {} already exists.".format(key))
+                keys.add(key)
+
+            removed = sorted(self._generated - keys)
+            for key in removed:
+                self.items.pop(key, None)
+            for key, source in generated:
+                self.items[key] = Item(filename=key, site=self, raw=source)
+            self._generated = keys
+            keys = sorted(keys)
+            if keys:
+                self.apply_rules(keys)
+            return keys, removed
+
+    def _load_snapshot(self, root):
+        # Loads the directory listings saved by the previous scan: {directory: (mtime, files, subdirectories)}
+        try:
+            with io.open(self.snapshot_path, "rb") as file:
+                data = json.loads(file.read())
+        except (IOError, OSError, ValueError):
+            return {}
+        if (data.get("version") != SNAPSHOT_VERSION or data.get("root") != root
+                or data.get("ignore") != list(self.ignore)):
+            return {}
+        saved = data["time"] - SNAPSHOT_MARGIN
+        return dict((directory, listing) for directory, listing in data["directories"].iteritems()
+                    if listing[0] < saved)
+
+    def _save_snapshot(self, root, directories):
+        from vasara.compiler import write_file
+
+        write_file(self.snapshot_path, json.dumps({
+            "version": SNAPSHOT_VERSION,
+            "root": root,
+            "ignore": list(self.ignore),
+            "time": time.time(),
+            "directories": directories,
+        }))
+
+    def rescan(self, paths):
+        """Updates the site's items after the specified files or directories have changed. Changed
+        items are unloaded so that they're read again, removed items are removed from
+        :attr:`~Site.items` and the recorded :attr:`~Site.rules` are applied to new items.
+
+        :param paths: list of changed absolute paths (files or directories)
+        :returns: tuple of lists: (changed and new item keys, removed item keys). Virtual items (see
+                  :meth:`~Site.generate`) are generated again if anything changed and included."""
+        root = os.path.abspath(self.items_path)
+        changed, removed, new = set(), set(), []
+
+        for path in paths:
+            path = os.path.abspath(path)
+            if path != root and not path.startswith(root + os.sep) or self._ignored(root, path):
+                continue
+            prefix = self._key(root, path)
+
+            if os.path.isdir(path):
+                found = set()
+                for key, full, stat in self._walk(path):
+                    found.add(key)
+                    self._update(key, full, stat, False, changed, new)
+                gone = [key for key, item in self.items.iteritems()
+                        if item.path is not None and _under(key, prefix) and key not in found]
+            elif os.path.isfile(path):
+                self._update(prefix, path, os.stat(path), True, changed, new)
+                gone = []
+            else:
+                gone = [key for key, item in self.items.iteritems() if item.path is not None and _under(key, prefix)]
+
+            for key in gone:
+                del self.items[key]
+                removed.add(key)
+                changed.discard(key)
+
+        new = [key for key in new if key in self.items]
+        if new:
+            self.apply_rules(new)
+
+        # Virtual items may depend on anything, so they're generated again after any change
+        if self.generators and (changed or removed):
+            generated, gone = self._generate()
+            changed.update(generated)
+            removed.update(gone)
+        return sorted(changed), sorted(removed)
+
+    def _update(self, key, full, stat, force, changed, new):
+        # Adds a new item or unloads an existing item if its file has changed.
+        item = self.items.get(key)
+        if item is None:
+            self.items[key] = Item(filename=key, site=self, path=full, size=stat.st_size, mtime=stat.st_mtime)
+            new.append(key)
+        elif force or item.size != stat.st_size or item.mtime != stat.st_mtime:
+            item.unload()
+            item.size, item.mtime = stat.st_size, stat.st_mtime
+        else:
+            return
+        changed.add(key)
+
+    def preload(self, keys=None):
+        """Reads and parses items in parallel using :attr:`~Site.workers` threads.
+
+        :param keys: list of item keys to load (default: all items)"""
+        items = [self.items[key] for key in keys] if keys is not None else self.items.values()
+        with profiler.measure("site", "preload"):
+            if self.workers > 1 and len(items) > 1:
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(self.workers)
+                try:
+                    pool.map(Item.load, items, chunksize=max(1, len(items) // (self.workers * 4)))
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for item in items:
+                    item.load()
+
+    def _walk(self, path):
+        # Walks a directory under the items path and yields tuples: (key, absolute path, stat).
+        # With several workers, the directories of each level of the tree are listed in parallel.
+        root = os.path.abspath(self.items_path)
+        pending = [os.path.abspath(path)]
+        pool = None
+        if self.workers > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(self.workers)
+        try:
+            while pending:
+                if pool is not None and len(pending) > 1:
+                    listings = pool.map(self._list, pending)
+                else:
+                    listings = map(self._list, pending)
+                pending = []
+                for files, directories in listings:
+                    for full, stat in files:
+                        yield self._key(root, full), full, stat
+                    pending.extend(directories)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def _list(self, directory):
+        # Lists a directory and returns a tuple of lists: ([(absolute path, stat)], [subdirectories]).
+        # Like os.walk, symbolic links to directories aren't followed. While scanning with a snapshot,
+        # the listings of unchanged directories are reused and the new listings are recorded.
+        if self._snapshot is None:
+            return self._list_directory(directory)
+        previous, listings = self._snapshot
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return [], []
 
-                # If on Windows, fix path separators in the key
-                if sys.platform == "win32":
-                    key = key.replace("\\", "/")
+        listing = previous.get(directory)
+        if listing is not None and listing[0] == mtime:
+            files = []
+            for name in listing[1]:
+                full = os.path.join(directory, name)
+                try:
+                    files.append((full, os.stat(full)))
+                except OSError:
+                    continue
+            directories = listing[2]
+        else:
+            files, directories = self._list_directory(directory)
+        listings[directory] = (mtime, [os.path.basename(full) for full, stat in files], directories)
+        return files, directories
 
-                self.items[key] = Item(filename=key, site=self, raw=io.open(full, "r").read())
+    def _list_directory(self, directory):
+        files, directories = [], []
+        try:
+            if scandir is not None:
+                # Directory entries know if they're directories without an extra stat call
+                entries = [(entry.name, entry.path, entry.is_dir(), entry.is_symlink(), entry) for entry in scandir(directory)]
+            else:
+                entries = []
+                for name in os.listdir(directory):
+                    full = os.path.join(directory, name)
+                    entries.append((name, full, os.path.isdir(full), os.path.islink(full), None))
+        except OSError:
+            # Removed while scanning
+            return files, directories
+
+        for name, full, is_dir, is_link, entry in entries:
+            if self._ignore is not None and self._ignore.match(name):
+                continue
+            if is_dir:
+                if not is_link:
+                    directories.append(full)
+                continue
+            try:
+                stat = entry.stat() if entry is not None else os.stat(full)
+            except OSError:
+                continue
+            files.append((full, stat))
+        return files, directories
+
+    def _ignored(self, root, path):
+        # Checks if any component of a path under the items path matches the ignore patterns.
+        if self._ignore is None:
+            return False
+        return any(self._ignore.match(name) for name in path[len(root):].split(os.sep) if name)
+
+    def _key(self, root, full):
+        key = full[len(root):][1:]
+
+        # If on Windows, fix path separators in the key
+        if sys.platform == "win32":
+            key = key.replace("\\", "/")
+        return key
+
+    def dependents(self, keys, dependencies=None):
+        """Finds the items that depend on the specified items, directly or through other items.
+
+        :param keys: list of item keys
+        :param dependencies: dependencies to use instead of :attr:`~Site.dependencies`
+        :returns: set of item keys, not including ``keys`` (unless there's a cycle)"""
+        if dependencies is None:
+            dependencies = self.dependencies
+        reverse = {}
+        for key, keys_read in dependencies.iteritems():
+            for dependency in keys_read:
+                reverse.setdefault(dependency, []).append(key)
+
+        found = set()
+        pending = list(keys)
+        while pending:
+            for dependent in reverse.get(pending.pop(), ()):
+                if dependent not in found:
+                    found.add(dependent)
+                    pending.append(dependent)
+        return found
+
+    @contextmanager
+    def _rendering(self, key):
+        # Marks an item as being filtered or templated in the current thread. Yields the set of items
+        # read while rendering it.
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        read = set()
+        stack.append((key, read))
+        try:
+            yield read
+        finally:
+            stack.pop()
+            if read and key is not None:
+                self._add_dependencies(key, read)
+
+    def _record(self, key):
+        # Called by items when they're read.
+        stack = getattr(self._local, "stack", None)
+        if stack and stack[-1][0] != key:
+            stack[-1][1].add(key)
+
+    def _add_dependencies(self, key, dependencies):
+        self.dependencies.setdefault(key, set()).update(dependencies)
+
+    def membership(self, dependency):
+        """Hashes the members of a membership dependency. Filters and templaters that list the items
+        (by iterating over :attr:`~Site.items`) or query them (see :meth:`~Site.query`) depend on the
+        set of items they found as well as on the items themselves: adding an item or changing an
+        item's metadata so that it's listed changes the result. These dependencies are recorded in
+        :attr:`~Site.dependencies` next to the item keys, and the compiler rebuilds an item when the
+        hash of any of its membership dependencies changes.
+
+        :param dependency: a dependency recorded in :attr:`~Site.dependencies`
+        :returns: a hash of the dependency's current members, or ``None`` if the dependency is an item key"""
+        if not is_membership(dependency):
+            return None
+        with self._rendering(None):
+            if dependency == ALL_ITEMS:
+                members = sorted(self.items)
+            else:
+                query = json.loads(dependency[len(MEMBERSHIP):])
+                index = self._query_index(query[0])
+                if len(query) == 1:
+                    # Sorting by the field or listing its values depends on every value
+                    members = [(key, index.values[key]) for key in index.sorted]
+                else:
+                    # JSON turns tuples into lists
+                    value = tuple(query[1]) if isinstance(query[1], list) else query[1]
+                    members = sorted(index.keys.get(value, ()))
+        return hashlib.sha1(json.dumps(members, default=repr)).hexdigest()
+
+    def _record_query(self, field, *value):
+        # Records a membership dependency on the items that have a metadata field, or on the items
+        # whose field has a value.
+        self._record(MEMBERSHIP + json.dumps([field] + list(value), sort_keys=True))
+
+    def query(self, where=None, sort=None, reverse=False, offset=0, limit=None):
+        """Finds items by their metadata, for example for listing, archive and tag pages. Queries are
+        answered from indexes of metadata fields that are built when a field is first queried and
+        rebuilt after items have been added, removed or changed, so a query costs roughly the size of
+        its result. Passthrough items are never included.
+
+        The indexes see the metadata as it was when they were built. If filters change the metadata
+        that is queried, filter the items first or call :meth:`~Site.invalidate_queries` afterwards.
+
+        When called from a filter or templater, the matching items are recorded as dependencies of
+        the item being rendered (see :attr:`~Site.dependencies`).
+
+        :param where: dictionary of metadata fields and values. Items match if each field equals
+                      the value or, if the field is a list (for example tags), contains it. Values
+                      must be hashable: to find the items with any of several values, query each
+                      value.
+        :param sort: a metadata field to sort the items by. Items without the field are left out.
+                     Items are sorted by their key otherwise.
+        :param reverse: if ``True``, the items are sorted in descending order
+        :param offset: the number of items to skip
+        :param limit: the maximum number of items to return (default: all)
+        :returns: list of items
+        :raises: ``ValueError`` if a value in ``where`` isn't hashable"""
+        with profiler.measure("site", "query"):
+            if where:
+                for field, value in where.iteritems():
+                    try:
+                        hash(value)
+                    except TypeError:
+                        raise ValueError("Can't query {} by the unhashable value {!r}.".format(field, value))
+                # Starts from the field with the fewest matches
+                matches = sorted((self._query_index(field).keys.get(value, ()) for field, value in where.iteritems()), key=len)
+                keys = set(matches[0]).intersection(*matches[1:])
+                if sort is not None:
+                    values = self._query_index(sort).values
+                    keys = sorted((key for key in keys if key in values), key=lambda key: (values[key], key), reverse=reverse)
+                else:
+                    keys = sorted(keys, reverse=reverse)
+            elif sort is not None:
+                keys = self._query_index(sort).sorted
+                if reverse:
+                    keys = keys[::-1]
+            else:
+                keys = sorted((key for key, item in self.items.iteritems() if not item.passthrough), reverse=reverse)
+
+            stack = getattr(self._local, "stack", None)
+            if stack:
+                stack[-1][1].update(keys)
+                if where:
+                    for field, value in where.iteritems():
+                        self._record_query(field, value)
+                elif sort is not None:
+                    self._record_query(sort)
+            end = offset + limit if limit is not None else None
+            return [self.items[key] for key in keys[offset:end]]
+
+    def paginate(self, per_page, where=None, sort=None, reverse=False):
+        """Splits the results of a query into pages. See :meth:`~Site.query`.
+
+        :param per_page: the number of items on each page
+        :returns: list of pages (lists of items). There's always at least one page."""
+        items = self.query(where=where, sort=sort, reverse=reverse)
+        return [items[start:start + per_page] for start in range(0, len(items), per_page)] or [[]]
+
+    def values(self, field):
+        """Lists the distinct values of a metadata field, for example all tags. The elements of list
+        fields are listed separately.
+
+        :param field: the metadata field
+        :returns: sorted list of values"""
+        self._record_query(field)
+        return sorted(self._query_index(field).keys)
+
+    def invalidate_queries(self):
+        """Discards the metadata indexes used by :meth:`~Site.query`. Items do this automatically when
+        they're unloaded or their metadata is replaced."""
+        self._metadata_version += 1
+
+    def _query_index(self, field):
+        # Returns the metadata index of a field, building it if it doesn't exist or the items have
+        # changed. Items read while building aren't recorded as dependencies.
+        version = (getattr(self.items, "version", None), self._metadata_version)
+        if version[0] is None or version != self._query_version:
+            self._query_indexes = {}
+            self._query_version = version
+        index = self._query_indexes.get(field)
+        if index is None:
+            with self._rendering(None):
+                index = _MetadataIndex(self.items, field)
+            self._query_indexes[field] = index
+        return index
+
+    def _chain(self, filters):
+        # Returns a shared tuple of filters, so that items with the same filters don't each keep a
+        # copy. Called by items when their filters are set.
+        try:
+            return self._chains.setdefault(filters, filters)
+        except TypeError:
+            # Unhashable filters can't be shared
+            return filters
 
     def match(self, expression):
         """Matches the site's items against the specified regular expression
@@ -39,35 +641,214 @@ class Site(object):
 
         :param expression: regular expression to match against item filename
         :returns: list of tuples: [(match, item)]"""
-        exp = re.compile(expression)
-        keys = self.items.keys()
-        items = []
-        for key in keys:
-            match = exp.match(key)
-            if match:
-                items.append((match, self.items[key]))
-        return items
+        with profiler.measure("site", "match"):
+            exp = _compile(expression)
+            items = []
+            for key in self._index().candidates(expression):
+                match = exp.match(key)
+                if match:
+                    items.append((match, self.items[key]))
+            return items
+
+    def apply_rules(self, keys=None):
+        """Applies the recorded :attr:`~Site.rules` to items in one pass. Each item gets its rules in
+        the order they were registered. Use this after registering rules with
+        :attr:`~Site.defer_rules` enabled, or to apply the rules to items added after the rules were
+        registered (for example new files found by a rescan).
+
+        Note that filters are appended to the items' filter lists, so rules should only be applied
+        once to each item.
+
+        :param keys: list of item keys to apply the rules to (default: all items)"""
+        with profiler.measure("site", "apply_rules"):
+            matches = {}
+            if keys is None:
+                index = self._index()
+                for position, (kind, expression, callable) in enumerate(self.rules):
+                    exp = _compile(expression)
+                    for key in index.candidates(expression):
+                        match = exp.match(key)
+                        if match:
+                            matches.setdefault(key, []).append((position, match))
+            else:
+                rules = [_compile(expression) for kind, expression, callable in self.rules]
+                for key in keys:
+                    for position, exp in enumerate(rules):
+                        match = exp.match(key)
+                        if match:
+                            matches.setdefault(key, []).append((position, match))
+
+            for key, found in matches.iteritems():
+                item = self.items[key]
+                for position, match in sorted(found, key=lambda pair: pair[0]):
+                    kind, expression, callable = self.rules[position]
+                    _APPLY[kind](match, item, callable)
+
+    def _rule(self, kind, expression, callable):
+        # Records a rule and applies it right away unless rules are deferred. The site is scanned
+        # first: the scan applies the recorded rules to generated items, which would get this rule
+        # twice if it had already been recorded.
+        self.items
+        self.rules.append((kind, expression, callable))
+        if not self.defer_rules:
+            for match, item in self.match(expression):
+                with profiler.measure("rule", kind):
+                    _APPLY[kind](match, item, callable)
+
+    def _index(self):
+        # Returns the rule index of the current items, rebuilding it if the items have changed.
+        version = getattr(self.items, "version", None)
+        index = getattr(self, "_rule_index", None)
+        if index is None or version is None or index.items is not self.items or index.version != version:
+            index = _RuleIndex(self.items, version)
+            self._rule_index = index
+        return index
 
     def route(self, expression, callable):
         """Matches and routes items using the specified router. See :func:`example.router` for more details on the ``callable``.
 
         :param expression: regular expression to match against item filename (see :func:`~Site.match`)
         :param callable: a callable object that takes two arguments: ``match`` and ``item`` and returns the route"""
-        for match, item in self.match(expression):
-            item.file_route = callable(match, item)
+        self._rule("route", expression, callable)
 
     def filter(self, expression, filter):
         """Matches and filters items using the specified filter. See :func:`example.filter` for more details on the ``filter``.
 
         :param expression: regular expression to match against item filename (see :func:`~Site.match`)
         :param filter: a callable object that takes the item as an argument"""
-        for match, item in self.match(expression):
-            item.filters.append(filter)
+        self._rule("filter", expression, filter)
 
     def template(self, expression, templater):
         """Matches and templates items using the specified templater. See :func:`example.templater` for more details on the ``templater``.
 
         :param expression: regular expression to match against item filename (see :func:`~Site.match`)
         :param templater: a callable object that takes the item as an argument"""
-        for match, item in self.match(expression):
-            item.templater = templater
\ No newline at end of file
+        self._rule("template", expression, templater)
+
+    def passthrough(self, expression):
+        """Marks items as passthrough assets (for example images, fonts and videos). Passthrough items
+        are never read into memory: the compiler copies their source files as they are. Items without a
+        route are routed to their filename.
+
+        :param expression: regular expression to match against item filename (see :func:`~Site.match`)"""
+        self._rule("passthrough", expression, None)
+
+class _RuleIndex(object):
+    # Narrows down the items that can match an expression: expressions with a literal prefix are
+    # looked up from a sorted list of keys and extension expressions (".*\.html$") from a dictionary
+    # of keys by extension. Everything else is matched against all keys.
+
+    def __init__(self, items, version):
+        self.items = items
+        self.version = version
+        self.keys = sorted(items.keys())
+        self.extensions = {}
+        for key in self.keys:
+            self.extensions.setdefault(key.rstrip("\n").rpartition(".")[2], []).append(key)
+
+    def candidates(self, expression):
+        if not isinstance(expression, basestring):
+            # Precompiled expressions may have flags that change their meaning
+            return self.keys
+        extension = EXTENSION.match(expression)
+        if extension:
+            return self.extensions.get(extension.group(1), [])
+        prefix = _literal_prefix(expression)
+        if not prefix:
+            return self.keys
+        start = bisect.bisect_left(self.keys, prefix)
+        end = start
+        while end < len(self.keys) and self.keys[end].startswith(prefix):
+            end += 1
+        return self.keys[start:end]
+
+class _MetadataIndex(object):
+    # Indexes a metadata field: item keys by value (the elements of list values are indexed
+    # separately), values by item key and the keys of the items with the field sorted by value.
+
+    def __init__(self, items, field):
+        self.keys = {}
+        self.values = {}
+        for key, item in items.iteritems():
+            if item.passthrough:
+                continue
+            metadata = item.metadata
+            if field not in metadata:
+                continue
+            value = self.values[key] = metadata[field]
+            for element in value if isinstance(value, list) else (value,):
+                try:
+                    self.keys.setdefault(element, []).append(key)
+                except TypeError:
+                    # Unhashable values can only be sorted by
+                    pass
+        self.sorted = sorted(self.values, key=lambda key: (self.values[key], key))
+
+_COMPILED = {}
+
+def _compile(expression):
+    # Compiled expressions are cached for the lifetime of the process.
+    exp = _COMPILED.get(expression)
+    if exp is None:
+        exp = _COMPILED[expression] = re.compile(expression)
+    return exp
+
+def is_membership(dependency):
+    """Checks if a dependency recorded in :attr:`Site.dependencies` is a membership dependency
+    rather than an item key. See :meth:`Site.membership`.
+
+    :param dependency: the dependency
+    :returns: ``True`` for membership dependencies"""
+    return dependency.startswith(MEMBERSHIP)
+
+def _literal_prefix(expression):
+    # Returns the literal string that every match of the expression must start with. Inline flags
+    # apply to the whole expression in Python 2 wherever they are, and (?i) makes the prefix
+    # case-insensitive.
+    if "|" in expression or "(?" in expression:
+        return ""
+    prefix = []
+    i = 0
+    while i < len(expression):
+        char = expression[i]
+        if char == "\\":
+            escaped = expression[i + 1:i + 2]
+            if not escaped or escaped.isalnum():
+                break
+            literal, i = escaped, i + 2
+        elif char in SPECIAL:
+            break
+        else:
+            literal, i = char, i + 1
+        # A quantifier after the literal makes it optional
+        following = expression[i:i + 1]
+        if following and following in "*?{":
+            break
+        prefix.append(literal)
+        if following == "+":
+            break
+    return "".join(prefix)
+
+def _under(key, prefix):
+    return not prefix or key == prefix or key.startswith(prefix + "/")
+
+def _apply_route(match, item, router):
+    item.file_route = router(match, item)
+
+def _apply_filter(match, item, filter):
+    item.filters = item._filters + (filter,)
+
+def _apply_template(match, item, templater):
+    item.templater = templater
+
+def _apply_passthrough(match, item, unused):
+    item.passthrough = True
+    if item.file_route is None:
+        item.file_route = item.filename
+
+_APPLY = {
+    "route": _apply_route,
+    "filter": _apply_filter,
+    "template": _apply_template,
+    "passthrough": _apply_passthrough,
+}
\ No newline at end of file
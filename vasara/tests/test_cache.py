@@ -0,0 +1,93 @@
+from unittest import TestCase
+from vasara.cache import ResultCache
+from vasara.item import Item
+from vasara.tests.common import build_test_site
+
+import os
+import shutil
+import tempfile
+
+TEST_ITEM = """---
+{
+    "name": "Test"
+}
+---
+
+Hello, world!"""
+
+class TestCache(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.site = build_test_site()
+        self.site.cache = ResultCache(self.path, templates=True)
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def build_item(self):
+        def upper_filter(item):
+            self.calls.append("filter")
+            item.filtered_content = item.filtered_content.upper()
+            item.metadata["filtered"] = True
+
+        def templater(item):
+            self.calls.append("templater")
+            return "<p>{}</p>".format(item.content)
+
+        item = Item(filename="test", site=self.site, raw=TEST_ITEM)
+        item.filters.append(upper_filter)
+        item.templater = templater
+        return item
+
+    def test_cached_results(self):
+        """Ensures that filter and templater results are reused by items with the same inputs."""
+        self.assertEqual("<p>HELLO, WORLD!</p>", self.build_item().templated)
+        self.assertEqual(["filter", "templater"], self.calls)
+
+        item = self.build_item()
+        self.assertEqual("HELLO, WORLD!", item.content)
+        self.assertEqual({"name": "Test", "filtered": True}, item.metadata)
+        self.assertEqual("<p>HELLO, WORLD!</p>", item.templated)
+        self.assertEqual(["filter", "templater"], self.calls)
+
+        # A different version invalidates the results
+        self.site.cache.version = "2"
+        self.build_item().templated
+        self.assertEqual(["filter", "templater"] * 2, self.calls)
+
+    def test_item_identity(self):
+        """Ensures that items with the same source don't share results."""
+        templated = []
+        for key in ("a/index.html", "b/index.html"):
+            item = Item(filename=key, site=self.site, raw="", route=key)
+            item.templater = lambda item: '<a href="{}">'.format(item.route)
+            templated.append(item.templated)
+        self.assertEqual(['<a href="a/">', '<a href="b/">'], templated)
+
+    def test_eviction(self):
+        """Ensures that the least recently used results are evicted when the cache is full."""
+        cache = ResultCache(self.path, max_size=100)
+        cache.put("a" * 40, "x" * 40)
+        os.utime(cache._path("a" * 40), (0, 0))
+        cache.put("b" * 40, "x" * 40)
+        cache.put("c" * 40, "x" * 40)
+
+        self.assertIsNone(cache.get("a" * 40))
+        self.assertEqual("x" * 40, cache.get("c" * 40))
+
+
+    def test_dependencies(self):
+        """Ensures that cached results aren't used if an item they depended on has changed."""
+        def templater(item):
+            self.calls.append("templater")
+            return "{} {}".format(item.content, self.site.items["other"].content)
+
+        for raw, expected in (("One", "Hello One"), ("One", "Hello One"), ("Two", "Hello Two")):
+            self.site.items["other"] = Item(filename="other", site=self.site, raw=raw)
+            item = Item(filename="test", site=self.site, raw="Hello")
+            item.templater = templater
+            self.assertEqual(expected, item.templated)
+
+        self.assertEqual(["templater", "templater"], self.calls)
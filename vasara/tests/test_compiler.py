@@ -1,13 +1,16 @@
 from unittest import TestCase
-from vasara.item import Item
+from vasara.item import Item, batch_filter
 from vasara.site import Site
-from vasara.compiler import Compiler
+from vasara.compiler import Compiler, CompileError, copy_file, shard_manifest_path, write_file
 
 from common import build_test_site, TEST_SITE
 
+import json
 import os
 import shutil
 import sys
+import tempfile
+import threading
 
 HERE = os.path.abspath(os.path.dirname(__file__))
 
@@ -34,4 +37,513 @@ class TestCompiler(TestCase):
         self.assertTrue(os.path.exists(os.path.join(output, "index.html")))
         self.assertTrue(os.path.exists(os.path.join(output, "test", "index.html")))
         self.assertTrue(os.path.exists(os.path.join(output, "test", "test", "index.html")))
-        self.assertTrue(os.path.exists(os.path.join(output, "test", "test", "test", "index.html")))
\ No newline at end of file
+        self.assertTrue(os.path.exists(os.path.join(output, "test", "test", "test", "index.html")))
+
+    def test_incremental(self):
+        """Ensures that incremental compilation only rebuilds changed items and removes stale outputs."""
+        calls = []
+        def templater(item):
+            calls.append(item.filename)
+            return item.content
+
+        self.compiler.manifest_path = os.path.join(self.compiler.output_path, "manifest.json")
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.site.template(r"(.*)", templater)
+        self.compiler.compile()
+        self.assertEqual(len(self.site.items), len(calls))
+
+        # Nothing has changed
+        del calls[:]
+        self.compiler.compile()
+        self.assertEqual([], calls)
+
+        # Change one item and remove another
+        changed = Item(filename="index.html", site=self.site, raw="Changed!", route="index.html")
+        changed.templater = templater
+        self.site.items["index.html"] = changed
+        del self.site.items["test.html"]
+        self.compiler.compile()
+
+        output = self.compiler.output_path
+        self.assertEqual(["index.html"], calls)
+        self.assertEqual("Changed!", open(os.path.join(output, "index.html")).read())
+        self.assertFalse(os.path.exists(os.path.join(output, "test.html")))
+        self.assertTrue(os.path.exists(os.path.join(output, "test", "test.html")))
+
+
+    def test_changed_filter(self):
+        """Ensures that items are rebuilt when the body of a filter changes."""
+        def original():
+            def process(item):
+                item.filtered_content = item.filtered_content.upper()
+            return process
+        def edited():
+            def process(item):
+                item.filtered_content = item.filtered_content.lower()
+            return process
+
+        self.compiler.manifest_path = os.path.join(self.compiler.output_path, "manifest.json")
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.site.filter(r"index.html", original())
+        self.compiler.compile()
+        path = os.path.join(self.compiler.output_path, "index.html")
+        self.assertEqual("<H1>NOTHING TO SEE HERE.</H1>", open(path).read().strip())
+
+        self.site = build_test_site()
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.site.filter(r"index.html", edited())
+        self.compiler.site = self.site
+        self.compiler.compile()
+        self.assertEqual("<h1>nothing to see here.</h1>", open(path).read().strip())
+
+    def test_backends(self):
+        """Ensures that all backends produce identical output."""
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.site.template(r"(.*)", lambda item: "{}: {}".format(item.filename, item.content))
+
+        outputs = []
+        for backend in ("serial", "threads", "processes", "pipeline"):
+            shutil.rmtree(self.compiler.output_path, ignore_errors=True)
+            Compiler(site=self.site, output_path=self.compiler.output_path, backend=backend, workers=2).compile()
+            outputs.append(dict((key, open(os.path.join(self.compiler.output_path, key)).read())
+                                for key in self.site.items))
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+        self.assertEqual(outputs[0], outputs[3])
+
+    def test_lazy_imports(self):
+        """Ensures that starting the command line tool and creating a compiler don't import modules
+        that only some builds need."""
+        import subprocess
+        code = ("import sys, vasara.cli, vasara; vasara.Compiler(site=None, output_path='output'); "
+                "print ','.join(name for name in ('multiprocessing', 'vasara.postprocess', 'vasara.index', "
+                "'tempfile', 'gzip', 'subprocess') if name in sys.modules)")
+        root = os.path.dirname(os.path.dirname(HERE))
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=root)
+        self.assertEqual("", output.strip())
+
+    def test_errors_collected(self):
+        """Ensures that failing items are reported and don't prevent other items from being built."""
+        def templater(item):
+            if item.filename == "test.html":
+                raise ValueError("Broken!")
+            return item.content
+
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.site.template(r"(.*)", templater)
+        self.compiler.backend = "threads"
+
+        with self.assertRaises(CompileError) as context:
+            self.compiler.compile()
+
+        self.assertEqual(["test.html"], [key for key, error in context.exception.errors])
+        self.assertIn("Broken!", context.exception.errors[0][1])
+        self.assertTrue(os.path.exists(os.path.join(self.compiler.output_path, "index.html")))
+
+
+    def test_passthrough(self):
+        """Ensures that passthrough items are copied as they are and skipped when unchanged."""
+        self.site.template(r"(.*)", lambda item: "Templated!")
+        self.site.passthrough(r"test/")
+        self.compiler.compile()
+
+        output = os.path.join(self.compiler.output_path, "test", "test.html")
+        source = self.site.items["test/test.html"]
+        self.assertEqual(open(source.path).read(), open(output).read())
+        self.assertFalse(source.loaded)
+        self.assertEqual(int(os.stat(source.path).st_mtime), int(os.stat(output).st_mtime))
+
+        # Unchanged files aren't copied again
+        inode = os.stat(output).st_ino
+        self.compiler.compile()
+        self.assertEqual(inode, os.stat(output).st_ino)
+
+    def test_copy_without_reading(self):
+        """Ensures that on Linux, files are copied by the kernel rather than read into Python."""
+        if not sys.platform.startswith("linux"):
+            return
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        source, destination = os.path.join(directory, "source"), os.path.join(directory, "destination")
+        data = os.urandom(3 * 1024 * 1024 + 17)
+        with open(source, "wb") as file:
+            file.write(data)
+
+        def copyfileobj(*args):
+            raise AssertionError("The file was read into Python.")
+        original = shutil.copyfileobj
+        shutil.copyfileobj = copyfileobj
+        try:
+            self.assertTrue(copy_file(source, destination))
+        finally:
+            shutil.copyfileobj = original
+        self.assertEqual(data, open(destination, "rb").read())
+
+    def test_copy_same_second(self):
+        """Ensures that files rewritten within the same second with the same size are copied again."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        source, destination = os.path.join(directory, "source"), os.path.join(directory, "destination")
+        write_file(source, "AAAA")
+        os.utime(source, (1000000000.25, 1000000000.25))
+        if os.stat(source).st_mtime == 1000000000:
+            # The filesystem doesn't store sub-second modification times
+            return
+        self.assertTrue(copy_file(source, destination))
+
+        write_file(source, "BBBB")
+        os.utime(source, (1000000000.75, 1000000000.75))
+        self.assertTrue(copy_file(source, destination))
+        self.assertEqual("BBBB", open(destination).read())
+        self.assertFalse(copy_file(source, destination))
+
+    def test_passthrough_link(self):
+        """Ensures that passthrough items can be hardlinked."""
+        self.site.passthrough(r"index.html")
+        self.compiler.link_assets = True
+        self.compiler.compile()
+
+        output = os.path.join(self.compiler.output_path, "index.html")
+        self.assertEqual(os.stat(self.site.items["index.html"].path).st_ino, os.stat(output).st_ino)
+
+
+    def test_skip_unchanged_output(self):
+        """Ensures that outputs are only replaced if their content changes."""
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.compiler.compile()
+
+        path = os.path.join(self.compiler.output_path, "index.html")
+        inode = os.stat(path).st_ino
+        self.compiler.compile()
+        self.assertEqual(inode, os.stat(path).st_ino)
+
+        self.site.template(r"index.html", lambda item: "Changed!")
+        self.compiler.compile()
+        self.assertEqual("Changed!", open(path).read())
+        self.assertEqual([], [name for name in os.listdir(self.compiler.output_path) if name.endswith(".tmp")])
+
+
+    def test_dependencies(self):
+        """Ensures that items that read other items are rebuilt when those items change."""
+        calls = []
+        def templater(item):
+            calls.append(item.filename)
+            if item.filename == "index.html":
+                return ", ".join(self.site.items[key].content for key in ("test.html", "test/test.html"))
+            return item.content
+
+        self.compiler.manifest_path = os.path.join(self.compiler.output_path, "manifest.json")
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.site.template(r"(.*)", templater)
+        self.compiler.compile()
+        self.assertEqual(set(["test.html", "test/test.html"]), self.site.dependencies["index.html"])
+
+        # The dependencies are kept in the manifest
+        site = build_test_site()
+        site.route(r"(.*)", lambda match, item: match.group(1))
+        site.template(r"(.*)", templater)
+        site.items["test.html"] = Item(filename="test.html", site=site, raw="Changed!", route="test.html")
+        site.items["test.html"].templater = templater
+        self.site = site
+
+        del calls[:]
+        Compiler(site=site, output_path=self.compiler.output_path, manifest_path=self.compiler.manifest_path).compile()
+        self.assertEqual(["index.html", "test.html"], sorted(calls))
+        self.assertIn("Changed!", open(os.path.join(self.compiler.output_path, "index.html")).read())
+
+
+    def test_membership_dependencies(self):
+        """Ensures that listing and query pages are rebuilt when items are added or start matching."""
+        def post(tags):
+            return '---\n{{"tags": {}}}\n---\nPost'.format(json.dumps(tags))
+
+        def listing(item):
+            return ", ".join(key for key in sorted(self.site.items) if key.startswith("p"))
+
+        def tagged(item):
+            return ", ".join(found.filename for found in self.site.query(where={"tags": "news"}))
+
+        def add(key, tags):
+            self.site.items[key] = Item(filename=key, site=self.site, raw=post(tags), route=key)
+
+        self.compiler.manifest_path = os.path.join(self.compiler.output_path, "manifest.json")
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.site.items["index.html"].templater = listing
+        self.site.items["test.html"].templater = tagged
+        add("p1.html", ["news"])
+        self.compiler.compile()
+
+        output = self.compiler.output_path
+        read = lambda route: open(os.path.join(output, route)).read()
+        self.assertEqual("p1.html", read("index.html"))
+        self.assertEqual("p1.html", read("test.html"))
+
+        add("p2.html", ["news"])
+        self.compiler.compile()
+        self.assertEqual("p1.html, p2.html", read("index.html"))
+        self.assertEqual("p1.html, p2.html", read("test.html"))
+
+        # Changing an item's metadata moves it into a query's results
+        add("p3.html", [])
+        self.compiler.compile()
+        self.assertEqual("p1.html, p2.html", read("test.html"))
+        add("p3.html", ["news"])
+        self.compiler.compile()
+        self.assertEqual("p1.html, p2.html, p3.html", read("test.html"))
+
+    def test_streaming(self):
+        """Ensures that templaters can return iterables of chunks that are written as they're generated."""
+        def templater(item):
+            yield u"<p>"
+            for number in range(1000):
+                yield u"{}\u00e4".format(number)
+            yield u"</p>"
+
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.site.template(r"index.html", templater)
+        self.compiler.compile()
+
+        path = os.path.join(self.compiler.output_path, "index.html")
+        expected = u"<p>{}</p>".format(u"".join(u"{}\u00e4".format(number) for number in range(1000)))
+        self.assertEqual(expected.encode("utf-8"), open(path, "rb").read())
+
+        # Identical streamed content doesn't replace the output
+        inode = os.stat(path).st_ino
+        self.assertFalse(write_file(path, iter([expected[:10], expected[10:]])))
+        self.assertEqual(inode, os.stat(path).st_ino)
+        self.assertTrue(write_file(path, iter([u"Changed!"])))
+        self.assertEqual("Changed!", open(path, "rb").read())
+        self.assertEqual([], [name for name in os.listdir(self.compiler.output_path) if name.endswith(".tmp")])
+
+    def test_streaming_dependencies(self):
+        """Ensures that the items read by a generator templater are recorded as its dependencies."""
+        def feed(item):
+            yield "<feed>"
+            yield self.site.items["test.html"].content.strip()
+            yield "</feed>"
+
+        self.compiler.manifest_path = os.path.join(self.compiler.output_path, "manifest.json")
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.site.template(r"index.html", feed)
+        self.compiler.compile()
+        self.assertEqual(set(["test.html"]), self.site.dependencies["index.html"])
+
+        changed = Item(filename="test.html", site=self.site, raw="Changed!", route="test.html")
+        self.site.items["test.html"] = changed
+        self.compiler.compile()
+        self.assertEqual("<feed>Changed!</feed>", open(os.path.join(self.compiler.output_path, "index.html")).read())
+
+    def test_shards(self):
+        """Ensures that shards compile separate items and that their manifests can be merged."""
+        def templater(item):
+            if item.filename == "index.html":
+                return item.site.items["test.html"].content
+            return item.content
+
+        def build(shard, changed=False):
+            site = build_test_site()
+            if changed:
+                site.items["test.html"] = Item(filename="test.html", site=site, raw="Changed!")
+            site.route(r"(.*)", lambda match, item: match.group(1))
+            site.template(r"(.*)", templater)
+            compiler = Compiler(site=site, output_path=self.compiler.output_path, manifest_path=manifest, shard=shard)
+            compiler.compile()
+            return compiler
+
+        manifest = os.path.join(self.compiler.output_path, "manifest.json")
+        first = build((1, 2))
+        second = build((2, 2))
+        self.assertEqual(set(self.site.items), set(first.manifest) | set(second.manifest))
+        self.assertEqual(set(), set(first.manifest) & set(second.manifest))
+        for key in self.site.items:
+            self.assertTrue(os.path.exists(os.path.join(self.compiler.output_path, key)))
+
+        first.merge_shards(2)
+        self.assertFalse(os.path.exists(shard_manifest_path(manifest, 1, 2)))
+        self.assertEqual(sorted(self.site.items), sorted(json.load(open(manifest))["items"]))
+
+        # Items depending on items of other shards are rebuilt when those change
+        self.assertIn("index.html", build((1, 2), changed=True).manifest)
+        self.assertEqual("Changed!", open(os.path.join(self.compiler.output_path, "index.html")).read())
+
+    def test_pipeline(self):
+        """Ensures that the pipeline backend builds every item and collects the errors of every stage."""
+        def templater(item):
+            if item.filename == "test.html":
+                raise ValueError("Broken!")
+            return item.content
+
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.site.template(r"(.*)", templater)
+        self.site.passthrough(r"test/test/")
+        self.site.items["missing.html"] = Item(filename="missing.html", site=self.site, route="missing.html",
+                                               path=os.path.join(TEST_SITE, "missing.html"))
+        self.compiler.backend = "pipeline"
+        self.compiler.queue_size = 1
+
+        with self.assertRaises(CompileError) as context:
+            self.compiler.compile()
+
+        errors = dict(context.exception.errors)
+        self.assertEqual(["missing.html", "test.html"], sorted(errors))
+        self.assertIn("Broken!", errors["test.html"])
+        self.assertIn("IOError", errors["missing.html"])
+        for key in ("index.html", "test/test.html", "test/test/test.html"):
+            self.assertTrue(os.path.exists(os.path.join(self.compiler.output_path, key)))
+
+    def test_generated_items(self):
+        """Ensures that generated items are compiled by every backend and incrementally."""
+        def pages(site):
+            for number in range(1, 4):
+                yield "page/{}.html".format(number), '---\n{{"page": {}}}\n---\n'.format(number)
+
+        templated = []
+        def templater(item):
+            templated.append(item.filename)
+            return "Page {}".format(item.metadata["page"])
+
+        self.site.generate(pages)
+        self.site.route(r"page/(.*)", lambda match, item: "page/{}".format(match.group(1)))
+        self.site.template(r"page/", templater)
+        self.compiler.manifest_path = os.path.join(self.compiler.output_path, "manifest.json")
+        self.compiler.backend = "processes"
+        self.compiler.workers = 2
+        self.compiler.compile()
+        self.assertEqual("Page 2", open(os.path.join(self.compiler.output_path, "page", "2.html")).read())
+
+        self.compiler.backend = "serial"
+        self.compiler.compile()
+        self.assertEqual([], templated)
+        # Unchanged generated items are hashed without being loaded
+        self.assertEqual([], [key for key in self.site.items if key.startswith("page/") and self.site.items[key].loaded])
+
+    def test_release_shared_items(self):
+        """Ensures that items read by many others can be released while they're being read."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        items = os.path.join(directory, "items")
+        os.makedirs(items)
+        write_file(os.path.join(items, "shared.txt"), '---\n{"title": "Shared"}\n---\nShared')
+        for number in range(400):
+            write_file(os.path.join(items, "{}.html".format(number)), "---\n{}\n---\nPage")
+
+        site = Site(base_path=directory, items_path=items)
+        site.route(r"(.*)", lambda match, item: match.group(1))
+        site.template(r".*\.html", lambda item: item.site.items["shared.txt"].metadata["title"])
+
+        # Switching threads as often as possible makes the race likely
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        self.addCleanup(sys.setcheckinterval, interval)
+        for backend in ("threads", "pipeline"):
+            compiler = Compiler(site=site, output_path=os.path.join(directory, backend), backend=backend,
+                                workers=8, release_items=True)
+            compiler.compile()
+            self.assertEqual("Shared", open(os.path.join(compiler.output_path, "399.html")).read())
+
+    def test_batch_filters(self):
+        """Ensures that the compiler filters items in batches and reports failed items separately."""
+        batches = []
+        failing = set()
+        @batch_filter
+        def batch(items):
+            batches.append(len(items))
+            for item in items:
+                if item.filename in failing:
+                    raise ValueError("Failed")
+                item.filtered_content = "Batched"
+
+        def compile():
+            for item in self.site.items.itervalues():
+                item.unload()
+            del batches[:]
+            self.compiler.compile()
+
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.site.filter(r".*", batch)
+        compile()
+        self.assertEqual([len(self.site.items)], batches)
+
+        # Items are batch filtered in chunks, right before they're built
+        self.compiler.batch_size = 3
+        compile()
+        self.assertEqual([3, 1], batches)
+        for backend in ("threads", "processes", "pipeline"):
+            shutil.rmtree(self.compiler.output_path)
+            self.compiler.backend = backend
+            self.compiler.workers = 2
+            compile()
+            self.assertEqual("Batched", open(os.path.join(self.compiler.output_path, "index.html")).read())
+
+        # A failed batch is filtered again item by item
+        failing.add("test.html")
+        self.compiler.backend = "serial"
+        with self.assertRaises(CompileError) as context:
+            compile()
+        self.assertEqual(["test.html"], [key for key, error in context.exception.errors])
+
+    def test_batch_filters_reading_other_batches(self):
+        """Ensures that filters of batched items can read items of batches filtered by other threads."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        items = os.path.join(directory, "items")
+        os.makedirs(items)
+        for number in range(16):
+            write_file(os.path.join(items, "{:02}.html".format(number)), "---\n{}\n---\nPage")
+        site = Site(base_path=directory, items_path=items)
+
+        # The compiler builds chunks of two items in this order: the filter of a reads d while the
+        # filter of b, in the other chunk, reads a
+        a, c, b, d = site.items.keys()[:4]
+        reads = {a: d, b: a}
+        started = dict((key, threading.Event()) for key in reads)
+        def read(item):
+            if item.filename in reads:
+                # Both filters run at the same time
+                started[item.filename].set()
+                for event in started.itervalues():
+                    event.wait(2)
+                item.filtered_content += item.site.items[reads[item.filename]].content
+
+        site.route(r"(.*)", lambda match, item: match.group(1))
+        site.filter(r".*", batch_filter(lambda items: None))
+        site.filter(r".*", read)
+        compiler = Compiler(site=site, output_path=os.path.join(directory, "output"), backend="threads",
+                            workers=2, batch_size=2)
+        thread = threading.Thread(target=compiler.compile)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual("PagePagePage", open(os.path.join(compiler.output_path, b)).read())
+
+    def test_release_items(self):
+        """Ensures that items are released once written and read again when other items need them."""
+        loaded = []
+        def templater(item):
+            if item.filename == "index.html":
+                return ", ".join(self.site.items[key].content.strip() for key in ("test.html", "test/test.html"))
+            loaded.append(len([other for other in self.site.items.itervalues() if other.loaded]))
+            return item.content
+
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.site.template(r"(.*)", templater)
+        self.site.filter(r"(.*)", lambda item: setattr(item, "filtered_content", item.filtered_content.upper()))
+        expected = ", ".join(self.site.items[key].content.strip() for key in ("test.html", "test/test.html"))
+        for item in self.site.items.itervalues():
+            item.release()
+
+        self.compiler.manifest_path = os.path.join(TEST_SITE, "manifest.json")
+        self.addCleanup(os.remove, self.compiler.manifest_path)
+        for backend in ("serial", "pipeline"):
+            del loaded[:]
+            self.compiler.backend = backend
+            self.compiler.release_items = True
+            self.compiler.compile()
+            self.assertEqual([], [key for key, item in self.site.items.iteritems() if item.loaded])
+            if backend == "serial":
+                # Only the item being built is in memory; the pipeline reads ahead of it
+                self.assertEqual(1, max(loaded))
+            self.assertEqual(expected, open(os.path.join(self.compiler.output_path, "index.html")).read())
+            shutil.rmtree(self.compiler.output_path)
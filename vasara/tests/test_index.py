@@ -0,0 +1,121 @@
+from unittest import TestCase
+from vasara.compiler import Compiler, copy_file, write_file
+from vasara.index import digest, read_index, write_sitemap
+from vasara.item import Item
+
+from common import build_test_site, TEST_SITE
+
+import hashlib
+import os
+import shutil
+
+class TestIndex(TestCase):
+
+    def setUp(self):
+        self.site = build_test_site()
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.site.template(r"(.*)", lambda item: "<p>{}</p>".format(item.filename))
+        output = os.path.join(TEST_SITE, "output")
+        self.compiler = Compiler(site=self.site, output_path=output,
+                                 manifest_path=os.path.join(output, "manifest.json"),
+                                 index_path=os.path.join(output, "index.jsonl"), index_fields=["title"])
+        if os.path.exists(output):
+            shutil.rmtree(output)
+
+    def index(self):
+        return dict((entry["key"], entry) for entry in read_index(self.compiler.index_path))
+
+    def test_index(self):
+        """Ensures that every output is indexed with its hash and metadata fields."""
+        self.site.items["about.html"] = Item(filename="about.html", site=self.site, route="about.html",
+                                             raw='---\n{"title": "About", "date": 1}\n---\nAbout')
+        self.site.items["about.html"].templater = lambda item: item.content
+        self.compiler.backend = "processes"
+        self.compiler.compile()
+
+        index = self.index()
+        self.assertEqual(sorted(self.site.items), sorted(index))
+        about = index["about.html"]
+        path = os.path.join(self.compiler.output_path, "about.html")
+        self.assertEqual("about.html", about["route"])
+        self.assertEqual(digest(path), about["hash"])
+        self.assertEqual(os.path.getsize(path), about["size"])
+        self.assertEqual({"title": "About"}, about["metadata"])
+        self.assertEqual({}, index["index.html"]["metadata"])
+
+        # Entries are sorted by route
+        routes = [entry["route"] for entry in read_index(self.compiler.index_path)]
+        self.assertEqual(sorted(routes), routes)
+
+    def test_incremental(self):
+        """Ensures that incremental builds only update the entries of changed and removed items."""
+        self.compiler.compile()
+        before = self.index()
+
+        changed = Item(filename="index.html", site=self.site, raw="Changed!", route="index.html")
+        changed.templater = lambda item: item.content
+        self.site.items["index.html"] = changed
+        del self.site.items["test.html"]
+        self.compiler.compile()
+
+        after = self.index()
+        self.assertNotIn("test.html", after)
+        self.assertNotEqual(before["index.html"]["hash"], after["index.html"]["hash"])
+        self.assertEqual(before["test/test.html"], after["test/test.html"])
+
+        # An index is created for an existing build without rebuilding it
+        os.remove(self.compiler.index_path)
+        self.compiler.compile()
+        self.assertEqual(after, self.index())
+
+    def test_hash_written(self):
+        """Ensures that outputs are hashed while they're written or copied instead of being read back."""
+        import vasara.index
+
+        self.site.passthrough(r"test/")
+        original = vasara.index.digest
+        def digest(path):
+            raise AssertionError("{} was read back".format(path))
+        vasara.index.digest = digest
+        try:
+            for backend in ("serial", "pipeline"):
+                self.compiler.backend = backend
+                if os.path.exists(self.compiler.output_path):
+                    shutil.rmtree(self.compiler.output_path)
+                self.compiler.compile()
+        finally:
+            vasara.index.digest = original
+
+        index = self.index()
+        self.assertEqual(sorted(self.site.items), sorted(index))
+        for entry in index.itervalues():
+            self.assertEqual(original(os.path.join(self.compiler.output_path, entry["route"])), entry["hash"])
+
+        # Unchanged files are hashed while they're compared
+        path = os.path.join(self.compiler.output_path, "test.html")
+        hash = hashlib.sha1()
+        self.assertFalse(write_file(path, open(path, "rb").read(), hash=hash))
+        self.assertEqual(index["test.html"]["hash"], hash.hexdigest())
+        hash = hashlib.sha1()
+        self.assertFalse(copy_file(self.site.items["test/test.html"].path,
+                                   os.path.join(self.compiler.output_path, "test/test.html"), hash=hash))
+        self.assertEqual(index["test/test.html"]["hash"], hash.hexdigest())
+
+    def test_shards(self):
+        """Ensures that the indexes of sharded builds are merged."""
+        for number in (1, 2):
+            self.compiler.shard = (number, 2)
+            self.compiler.compile()
+        self.compiler.merge_shards(2)
+        self.assertEqual(sorted(self.site.items), sorted(self.index()))
+
+    def test_sitemap(self):
+        """Ensures that sitemaps are written from the index."""
+        self.compiler.compile()
+        path = os.path.join(self.compiler.output_path, "sitemap.xml")
+        self.assertTrue(write_sitemap(self.compiler.index_path, path, "https://example.com"))
+        sitemap = open(path).read()
+        self.assertIn("<loc>https://example.com/</loc>", sitemap)
+        self.assertIn("<loc>https://example.com/test/test.html</loc>", sitemap)
+        self.assertEqual(len(self.site.items), sitemap.count("<url>"))
+        self.assertFalse(write_sitemap(self.compiler.index_path, path, "https://example.com"))
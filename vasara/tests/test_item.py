@@ -1,7 +1,12 @@
 from unittest import TestCase
-from vasara.item import Item
+from vasara.item import Item, MATCHER, batch_filter, callable_identity, filter_items, split_front_matter
 from vasara.tests.common import build_test_site
 
+import functools
+import os
+import shutil
+import tempfile
+
 TEST_ITEM = """---
 {
     "name": "Test",
@@ -62,4 +67,174 @@ class TestItem(TestCase):
     def test_pretty_route(self):
         """Ensures that the route property displays a "prettified" route."""
         self.item.file_route = "test/index.html"
-        self.assertEqual("test/", self.item.route)
\ No newline at end of file
+        self.assertEqual("test/", self.item.route)
+
+    def test_signature(self):
+        """Ensures that the signature changes when the item's filters or templater change."""
+        signature = self.item.signature
+        self.assertEqual(signature, self.item.signature)
+
+        self.item.filters.append(lambda item: None)
+        self.assertNotEqual(signature, self.item.signature)
+
+        signature = self.item.signature
+        self.item.templater = lambda item: "Templated!"
+        self.assertNotEqual(signature, self.item.signature)
+
+
+    def test_unload_without_source(self):
+        """Ensures that items without a source file keep their contents when unloaded."""
+        self.item.unload()
+        self.assertEqual("Test", self.item.metadata["name"])
+
+    def test_split_front_matter(self):
+        """Ensures that the front matter parser agrees with MATCHER."""
+        for text in (TEST_ITEM, "Hello!", "---\n{}\n---", "---\n{}\n  \n---\n\nBody\n---\nMore", "--- {}\n---\nBody",
+                     "---\n{\"a\": \"---\"}\n---Body", "----\n{}\n---\n"):
+            match = MATCHER.match(text)
+            metadata, offset = split_front_matter(text)
+            expected = (match.group(1), match.group(2)) if match else (None, text)
+            self.assertEqual(expected, (metadata, text[offset:]))
+
+    def test_metadata_only(self):
+        """Ensures that reading an item's metadata doesn't read the rest of its source file."""
+        path = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(path, "test.html")
+            with open(filename, "wb") as file:
+                file.write(TEST_ITEM)
+            item = Item(filename="test.html", site=self.site, path=filename)
+
+            item.metadata["name"] = "Changed"
+            self.assertFalse(item.loaded)
+            self.assertEqual([1, 2, 3], item.metadata["list"])
+
+            # Loading the contents keeps the metadata
+            self.assertEqual("Hello, world! This is the actual content.", item.raw_content)
+            self.assertEqual("Changed", item.metadata["name"])
+        finally:
+            shutil.rmtree(path)
+
+    def test_shared_filters(self):
+        """Ensures that items with the same filters share them and that changes to the filter list are kept."""
+        def first(item):
+            pass
+        def second(item):
+            pass
+
+        self.site.filter(r".*\.html", first)
+        self.site.filter(r"test", second)
+        items = [self.site.items[key] for key in ("test.html", "test/test.html")]
+        self.assertEqual([first, second], items[0].filters)
+        self.assertIs(items[0]._filters, items[1]._filters)
+
+        items[0].filters.append(first)
+        items[0].filters += [second]
+        self.assertEqual([first, second, first, second], items[0].filters)
+        self.assertEqual([first, second], items[1].filters)
+        del items[0].filters[2:]
+        self.assertIs(items[0]._filters, items[1]._filters)
+
+    def test_release_raw(self):
+        """Ensures that the raw contents are released after filtering and read again when needed."""
+        def replacer_filter(item):
+            item.filtered_content = "Unit Testing!"
+
+        self.item.filters.append(replacer_filter)
+        self.assertEqual("Unit Testing!", self.item.content)
+        self.assertIsNone(self.item._raw)
+        self.assertEqual("Hello, world! This is the actual content.", self.item.raw_content)
+        self.assertEqual("Unit Testing!", self.item.content)
+
+    def test_batch_filter(self):
+        """Ensures that batch filters are called once per batch, in order with the other filters."""
+        batches = []
+        def before(item):
+            item.filtered_content = "<" + item.filtered_content.strip()
+        @batch_filter
+        def batch(items):
+            batches.append(sorted(item.filename for item in items))
+            for item in items:
+                item.filtered_content += "|"
+        def after(item):
+            item.filtered_content += ">"
+
+        self.site.filter(r".*", before)
+        self.site.filter(r".*", batch)
+        self.site.filter(r".*", after)
+        self.site.items["test.html"].filters.append(after)
+        filter_items([self.site.items[key] for key in sorted(self.site.items)], size=2)
+        self.assertEqual([["index.html", "test/test.html"], ["test/test/test.html"], ["test.html"]], batches)
+        for key, end in (("test.html", "|>>"), ("index.html", "|>")):
+            item = self.site.items[key]
+            self.assertEqual("<" + item.raw_content.strip() + end, item.content)
+
+        # Items filtered on their own are batches of one
+        del batches[:]
+        item = Item(filename="single", site=self.site, raw="x")
+        item.filters = [before, batch, after]
+        self.assertEqual("<x|>", item.content)
+        self.assertEqual([["single"]], batches)
+
+    def test_batch_filter_error(self):
+        """Ensures that items of a failed batch are left unfiltered."""
+        @batch_filter
+        def failing(items):
+            for item in items:
+                item.filtered_content = "Partial"
+            raise ValueError("Failed")
+
+        self.site.filter(r".*", failing)
+        with self.assertRaises(ValueError):
+            filter_items(self.site.items.values())
+        item = self.site.items["index.html"]
+        self.assertFalse(item.filtered)
+        self.assertNotEqual("Partial", item.filtered_content)
+
+    def test_hash_source(self):
+        """Ensures that sources are hashed without loading the items, identically to source_hash."""
+        item = self.site.items["index.html"]
+        hash = item.hash_source()
+        self.assertFalse(item.loaded)
+        self.assertEqual(item.source_hash, hash)
+        self.assertEqual(self.item.source_hash, self.item.hash_source())
+
+        generated = Item(filename="generated.html", site=self.site, raw=lambda: "---\n{}\n---\nGenerated")
+        hash = generated.hash_source()
+        self.assertFalse(generated.loaded)
+        self.assertEqual(generated.source_hash, hash)
+
+    def test_callable_identity(self):
+        """Ensures that callables are identified by their code, closures, defaults and arguments."""
+        def upper(item):
+            item.filtered_content = item.filtered_content.upper()
+        def lower(item):
+            item.filtered_content = item.filtered_content.lower()
+        lower.__name__ = "upper"
+        self.assertNotEqual(callable_identity(upper), callable_identity(lower))
+
+        def templater(item, layout=None):
+            return layout
+        self.assertEqual(callable_identity(functools.partial(templater, layout="x")),
+                         callable_identity(functools.partial(templater, layout="x")))
+        self.assertNotEqual(callable_identity(functools.partial(templater, layout="x")),
+                            callable_identity(functools.partial(templater, layout="y")))
+
+        def factory(value):
+            return lambda item: value
+        self.assertEqual(callable_identity(factory(1)), callable_identity(factory(1)))
+        self.assertNotEqual(callable_identity(factory(1)), callable_identity(factory(2)))
+        self.assertNotEqual(callable_identity(lambda item, value=1: value),
+                            callable_identity(lambda item, value=2: value))
+
+        # Closures over objects are identified by the object's type, not its address
+        def holder(value):
+            return lambda item: value
+        self.assertEqual(callable_identity(holder(object())), callable_identity(holder(object())))
+
+        # Bound methods are identified by their function
+        class Templater(object):
+            def render(self, item):
+                return item.content
+        self.assertEqual(callable_identity(Templater().render), callable_identity(Templater().render))
+        self.assertIn("render", callable_identity(Templater().render))
@@ -0,0 +1,74 @@
+from unittest import TestCase
+from vasara.compiler import Compiler
+from vasara.postprocess import minify_css, minify_html
+
+from common import build_test_site, TEST_SITE
+
+import gzip
+import os
+import shutil
+
+class TestPostprocess(TestCase):
+
+    def setUp(self):
+        self.site = build_test_site()
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.compiler = Compiler(site=self.site, output_path=os.path.join(TEST_SITE, "output"))
+        if os.path.exists(self.compiler.output_path):
+            shutil.rmtree(self.compiler.output_path)
+
+    def test_minify_html(self):
+        """Ensures that HTML is minified without touching preformatted contents."""
+        html = "<p>\n  Hello,   <b>world</b> <!-- comment -->\n</p>\n<pre>  keep\n   this </pre>  <!--[if IE]>x<![endif]-->"
+        self.assertEqual("<p>\nHello, <b>world</b>\n</p>\n<pre>  keep\n   this </pre> <!--[if IE]>x<![endif]-->",
+                         minify_html(html))
+
+    def test_minify_css(self):
+        """Ensures that CSS is minified without touching strings."""
+        css = "/* comment */\na > b, c :hover {\n  color: red;\n  content: \"a  /* b */ ;\";\n}\n"
+        self.assertEqual("a>b,c :hover{color:red;content:\"a  /* b */ ;\"}", minify_css(css))
+
+    def test_postprocess(self):
+        """Ensures that outputs are post-processed and precompressed, and that unchanged outputs
+        aren't compressed again."""
+        self.site.template(r"(.*)", lambda item: "<p>   {}   </p>".format(item.filename) * 100)
+        self.site.passthrough(r"test/test/")
+        self.compiler.postprocess(r".*\.html$", minify_html)
+        self.compiler.precompress(r".*\.html$", formats=["gzip"])
+        self.compiler.compile()
+
+        output = self.compiler.output_path
+        self.assertEqual("<p> index.html </p>" * 100, open(os.path.join(output, "index.html")).read())
+        with gzip.open(os.path.join(output, "index.html.gz")) as file:
+            self.assertEqual("<p> index.html </p>" * 100, file.read())
+        self.assertEqual(minify_html(open(self.site.items["test/test/test.html"].path).read()),
+                         open(os.path.join(output, "test", "test", "test.html")).read())
+
+        inode = os.stat(os.path.join(output, "index.html.gz")).st_ino
+        self.compiler.compile()
+        self.assertEqual(inode, os.stat(os.path.join(output, "index.html.gz")).st_ino)
+
+        # Variants are removed with their outputs
+        del self.site.items["index.html"]
+        self.compiler.compile()
+        self.assertFalse(os.path.exists(os.path.join(output, "index.html.gz")))
+
+    def test_unavailable_format(self):
+        """Ensures that unknown compression formats are rejected."""
+        with self.assertRaises(ValueError):
+            self.compiler.precompress(r".*", formats=["zip"])
+
+    def test_incremental(self):
+        """Ensures that adding post-processors or compression formats rebuilds the outputs."""
+        self.site.template(r"(.*)", lambda item: "<p>   {}   </p>".format(item.filename) * 100)
+        self.compiler.manifest_path = os.path.join(self.compiler.output_path, "manifest.json")
+        self.compiler.compile()
+
+        output = self.compiler.output_path
+        self.compiler.postprocess(r".*\.html$", minify_html)
+        self.compiler.compile()
+        self.assertEqual("<p> index.html </p>" * 100, open(os.path.join(output, "index.html")).read())
+
+        self.compiler.precompress(r".*\.html$", formats=["gzip"])
+        self.compiler.compile()
+        self.assertTrue(os.path.exists(os.path.join(output, "index.html.gz")))
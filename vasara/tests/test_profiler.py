@@ -0,0 +1,43 @@
+from unittest import TestCase
+from vasara import profiler
+from vasara.compiler import Compiler
+from vasara.tests.common import build_test_site, TEST_SITE
+
+import os
+import shutil
+
+def upper_filter(item):
+    item.filtered_content = item.filtered_content.upper()
+
+class TestProfiler(TestCase):
+
+    def setUp(self):
+        self.profiler = profiler.enable(trace=True)
+        self.site = build_test_site()
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+        self.site.filter(r"(.*)", upper_filter)
+        self.output_path = os.path.join(TEST_SITE, "output")
+        shutil.rmtree(self.output_path, ignore_errors=True)
+
+    def tearDown(self):
+        profiler.disable()
+
+    def test_stages(self):
+        """Ensures that filters and compilation stages are measured."""
+        Compiler(site=self.site, output_path=self.output_path).compile()
+
+        stages = self.profiler.stages
+        count = len(self.site.items)
+        self.assertEqual(count, stages[("filter", "vasara.tests.test_profiler.upper_filter")][0])
+        self.assertEqual(count, stages[("compiler", "build")][0])
+        self.assertEqual(sorted(self.site.items), sorted(self.profiler.items))
+
+        report = self.profiler.report(slowest=2)
+        self.assertEqual(2, len(report["slowest_items"]))
+        self.assertGreater(report["peak_rss"], 0)
+        self.assertEqual(len(self.profiler.events), len(self.profiler.chrome_trace()["traceEvents"]))
+
+    def test_processes(self):
+        """Ensures that measurements from worker processes are collected."""
+        Compiler(site=self.site, output_path=self.output_path, backend="processes", workers=2).compile()
+        self.assertEqual(len(self.site.items), self.profiler.stages[("compiler", "build")][0])
@@ -0,0 +1,56 @@
+from unittest import TestCase
+from vasara.server import Server
+from vasara.tests.common import build_test_site
+
+import threading
+import urllib2
+
+class TestServer(TestCase):
+
+    def setUp(self):
+        self.renders = []
+        def templater(item):
+            self.renders.append(item.filename)
+            return "Hello from {}".format(item.filename)
+
+        self.site = build_test_site()
+        self.site.route(r"(.*)\.html", lambda match, item: "{}/index.html".format(match.group(1)))
+        self.site.route(r"index.html", lambda match, item: "index.html")
+        self.site.template(r"(.*)", templater)
+
+        self.server = Server(self.site, port=0)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:{}".format(self.server.httpd.server_address[1])
+
+    def tearDown(self):
+        self.server.httpd.shutdown()
+        self.server.httpd.server_close()
+
+    def get(self, path, etag=None):
+        request = urllib2.Request(self.url + path)
+        if etag is not None:
+            request.add_header("If-None-Match", etag)
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            return e.code, e.read(), e.headers.get("ETag")
+        return response.getcode(), response.read(), response.headers.get("ETag")
+
+    def test_serve(self):
+        """Ensures that items are rendered by route and cached."""
+        self.assertEqual((200, "Hello from index.html"), self.get("/")[:2])
+        self.assertEqual((200, "Hello from test/test.html"), self.get("/test/test/")[:2])
+        self.assertEqual((200, "Hello from test/test.html"), self.get("/test/test")[:2])
+        self.assertEqual(404, self.get("/nothing/")[0])
+        self.assertEqual(["index.html", "test/test.html"], self.renders)
+
+    def test_etag(self):
+        """Ensures that unchanged responses are answered with 304 and invalidated responses are rendered again."""
+        code, body, etag = self.get("/")
+        self.assertEqual(304, self.get("/", etag=etag)[0])
+
+        self.server.cache.invalidate(["index.html"])
+        self.assertEqual(304, self.get("/", etag=etag)[0])
+        self.assertEqual(["index.html", "index.html"], self.renders)
@@ -1,8 +1,12 @@
 from unittest import TestCase
-from vasara.site import Site
-from common import build_test_site
+from vasara.item import Item
+from vasara.site import ALL_ITEMS, Site, is_membership
+from common import build_test_site, TEST_SITE
 
 import os
+import re
+import shutil
+import tempfile
 
 class TestSite(TestCase):
 
@@ -57,4 +61,246 @@ class TestSite(TestCase):
 
         # Since an item can only have one templater, the index templater should have been overwritten
         self.assertEqual("INDEX", self.site.items["index.html"].templated)
-        self.assertEqual("ALL", self.site.items["test/test.html"].templated)
\ No newline at end of file
+        self.assertEqual("ALL", self.site.items["test/test.html"].templated)
+
+    def test_lazy_items(self):
+        """Ensures that scanning and routing don't read the items' contents."""
+        self.site.route(r"(.*)", lambda match, item: match.group(1))
+
+        for item in self.site.items.itervalues():
+            self.assertFalse(item.loaded)
+            self.assertIsNotNone(item.size)
+
+        item = self.site.items["index.html"]
+        self.assertEqual("<h1>Nothing to see here.</h1>", item.content)
+        self.assertTrue(item.loaded)
+
+        item.unload()
+        self.assertFalse(item.loaded)
+        self.assertFalse(item.filtered)
+        self.assertEqual({}, item.metadata)
+
+
+    def test_match_index(self):
+        """Ensures that prefix and extension expressions match the same items as a full scan."""
+        for expression in (r"test", r"test/", r"test/(.*)\.html", r".*\.html$", r"(.*)\.(html)\Z", r"index\.html", r"x",
+                           r"TEST/(?i)", r"(?i)INDEX\.html"):
+            expected = sorted(key for key in self.site.items if re.match(expression, key))
+            self.assertEqual(expected, sorted(item.filename for match, item in self.site.match(expression)))
+
+        # The index is rebuilt when items change
+        self.site.items["test/new.html"] = Item(filename="test/new.html", site=self.site, raw="New!")
+        self.assertIn("test/new.html", [item.filename for match, item in self.site.match(r"test/")])
+
+    def test_deferred_rules(self):
+        """Ensures that deferred rules are applied in registration order."""
+        site = Site(base_path=TEST_SITE, items_path=os.path.join(TEST_SITE, "items"), defer_rules=True)
+        site.route(r"(.*)", lambda match, item: "{}/index.html".format(os.path.splitext(match.group(1))[0]))
+        site.route(r"index.html", lambda match, item: "index.html")
+        site.filter(r".*\.html$", lambda item: item)
+        site.template(r"(.*)", lambda item: "ALL")
+        site.template(r"index.html", lambda item: "INDEX")
+        self.assertIsNone(site.items["index.html"].file_route)
+
+        site.apply_rules()
+        self.assertEqual("index.html", site.items["index.html"].file_route)
+        self.assertEqual("test/test/index.html", site.items["test/test.html"].file_route)
+        self.assertEqual(1, len(site.items["test/test.html"].filters))
+        self.assertEqual("INDEX", site.items["index.html"].templated)
+
+        # Rules can be applied to items added later
+        site.items["new.html"] = Item(filename="new.html", site=site, raw="New!")
+        site.apply_rules(["new.html"])
+        self.assertEqual("new/index.html", site.items["new.html"].file_route)
+        self.assertEqual("ALL", site.items["new.html"].templated)
+
+
+    def test_rescan(self):
+        """Ensures that rescanning picks up changed, new and removed items."""
+        base = tempfile.mkdtemp()
+        try:
+            items = os.path.join(base, "items")
+            shutil.copytree(os.path.join(TEST_SITE, "items"), items)
+            site = Site(base_path=base, items_path=items)
+            site.route(r"(.*)", lambda match, item: match.group(1))
+            self.assertEqual("<h1>Nothing to see here.</h1>", site.items["index.html"].content)
+
+            with open(os.path.join(items, "index.html"), "w") as file:
+                file.write("Changed!")
+            with open(os.path.join(items, "test", "new.html"), "w") as file:
+                file.write("New!")
+            shutil.rmtree(os.path.join(items, "test", "test"))
+
+            changed, removed = site.rescan([os.path.join(items, "index.html"), os.path.join(items, "test")])
+            self.assertEqual(["index.html", "test/new.html"], changed)
+            self.assertEqual(["test/test/test.html"], removed)
+            self.assertEqual("Changed!", site.items["index.html"].content)
+            self.assertEqual("test/new.html", site.items["test/new.html"].file_route)
+        finally:
+            shutil.rmtree(base)
+
+
+    def test_parallel_scan(self):
+        """Ensures that scanning with several workers finds the same items and can preload them."""
+        site = Site(base_path=TEST_SITE, items_path=os.path.join(TEST_SITE, "items"), workers=4, preload=True)
+        self.assertEqual(sorted(self.site.items), sorted(site.items))
+        for key, item in site.items.iteritems():
+            self.assertTrue(item.loaded)
+            self.assertEqual(self.site.items[key].size, item.size)
+
+    def test_ignore(self):
+        """Ensures that ignored files and directories are skipped."""
+        site = Site(base_path=TEST_SITE, items_path=os.path.join(TEST_SITE, "items"), ignore=["test", "*.swp"])
+        self.assertEqual(["index.html", "test.html"], sorted(site.items))
+
+        site = Site(base_path=TEST_SITE, items_path=os.path.join(TEST_SITE, "items"), ignore=["test.html"])
+        self.assertEqual(["index.html"], sorted(site.items))
+        self.assertEqual(([], []), site.rescan([os.path.join(TEST_SITE, "items", "test", "test.html")]))
+
+    def test_query(self):
+        """Ensures that items can be queried, sorted and paginated by their metadata."""
+        posts = [("a.html", '{"date": "2012-04-22", "tags": ["gnomes", "news"]}'),
+                 ("b.html", '{"date": "2012-04-20", "tags": ["gnomes"]}'),
+                 ("c.html", '{"date": "2012-04-24", "tags": ["news"], "draft": true}')]
+        for key, metadata in posts:
+            self.site.items[key] = Item(filename=key, site=self.site, raw="---\n{}\n---\nPost".format(metadata))
+
+        keys = lambda items: [item.filename for item in items]
+        self.assertEqual(["a.html", "b.html"], keys(self.site.query(where={"tags": "gnomes"})))
+        self.assertEqual(["a.html"], keys(self.site.query(where={"tags": "gnomes", "date": "2012-04-22"})))
+        self.assertEqual(["c.html", "a.html", "b.html"], keys(self.site.query(sort="date", reverse=True)))
+        self.assertEqual(["a.html"], keys(self.site.query(sort="date", offset=1, limit=1)))
+        self.assertEqual([["b.html", "a.html"], ["c.html"]],
+                         [keys(page) for page in self.site.paginate(2, sort="date")])
+        self.assertEqual(["gnomes", "news"], self.site.values("tags"))
+        self.assertRaises(ValueError, self.site.query, where={"tags": ["gnomes", "news"]})
+
+        # The indexes are rebuilt when items change
+        self.site.items["a.html"].metadata = {"date": "2012-04-22", "tags": []}
+        self.assertEqual(["b.html"], keys(self.site.query(where={"tags": "gnomes"})))
+        del self.site.items["b.html"]
+        self.assertEqual([], self.site.query(where={"tags": "gnomes"}))
+
+    def test_query_dependencies(self):
+        """Ensures that queries made while rendering record the matching items as dependencies."""
+        for key in ("a.html", "b.html"):
+            self.site.items[key] = Item(filename=key, site=self.site, raw='---\n{"tags": ["news"]}\n---\nPost')
+
+        def templater(item):
+            return ", ".join(post.filename for post in self.site.query(where={"tags": "news"}))
+
+        self.site.items["index.html"].templater = templater
+        self.assertEqual("a.html, b.html", self.site.items["index.html"].templated)
+        dependencies = self.site.dependencies["index.html"]
+        self.assertEqual(set(["a.html", "b.html"]), set(key for key in dependencies if not is_membership(key)))
+        self.assertNotIn(None, self.site.dependencies)
+
+        # The query is recorded as a membership dependency that changes when an item starts matching
+        memberships = [key for key in dependencies if is_membership(key)]
+        self.assertEqual(1, len(memberships))
+        before = self.site.membership(memberships[0])
+        self.site.items["index.html"].metadata = {"tags": ["news"]}
+        self.assertNotEqual(before, self.site.membership(memberships[0]))
+
+    def test_listing_dependencies(self):
+        """Ensures that listing the items while rendering records a membership dependency."""
+        def templater(item):
+            return ", ".join(sorted(self.site.items))
+
+        self.site.items["index.html"].templater = templater
+        self.site.items["index.html"].templated
+        self.assertIn(ALL_ITEMS, self.site.dependencies["index.html"])
+        before = self.site.membership(ALL_ITEMS)
+        self.site.items["new.html"] = Item(filename="new.html", site=self.site, raw="New")
+        self.assertNotEqual(before, self.site.membership(ALL_ITEMS))
+
+    def test_lazy_scan(self):
+        """Ensures that the site is only scanned when its items are first needed."""
+        site = Site(base_path=TEST_SITE, items_path=os.path.join(TEST_SITE, "items"))
+        self.assertIsNone(site._items)
+        self.assertEqual(sorted(self.site.items), sorted(site.items))
+
+    def test_snapshot(self):
+        """Ensures that scanning with a snapshot reuses the listings of unchanged directories."""
+        base = tempfile.mkdtemp()
+        try:
+            items = os.path.join(base, "items")
+            shutil.copytree(os.path.join(TEST_SITE, "items"), items)
+            snapshot = os.path.join(base, "snapshot.json")
+            # Directories modified right before scanning are always listed
+            old = os.stat(items).st_mtime - 60
+            for dirpath, dirnames, filenames in os.walk(items):
+                os.utime(dirpath, (old, old))
+
+            create = lambda: Site(base_path=base, items_path=items, snapshot_path=snapshot)
+            self.assertEqual(sorted(self.site.items), sorted(create().items))
+
+            listed = []
+            site = create()
+            list_directory = site._list_directory
+            site._list_directory = lambda directory: listed.append(directory) or list_directory(directory)
+            self.assertEqual(sorted(self.site.items), sorted(site.items))
+            self.assertEqual([], listed)
+
+            # Changed files and directories are noticed
+            with open(os.path.join(items, "test.html"), "w") as file:
+                file.write("Changed!")
+            with open(os.path.join(items, "test", "new.html"), "w") as file:
+                file.write("New!")
+            site = create()
+            self.assertEqual("Changed!", site.items["test.html"].content)
+            self.assertIn("test/new.html", site.items)
+        finally:
+            shutil.rmtree(base)
+
+    def test_generate(self):
+        """Ensures that generated items are routed, templated and generated again after changes."""
+        base = tempfile.mkdtemp()
+        try:
+            items = os.path.join(base, "items")
+            os.makedirs(items)
+            with open(os.path.join(items, "a.html"), "w") as file:
+                file.write('---\n{"tags": ["gnomes"]}\n---\nA')
+
+            calls = []
+            def tag_pages(site):
+                for tag in site.values("tags"):
+                    def source(tag=tag):
+                        calls.append(tag)
+                        return '---\n{{"tag": "{}"}}\n---\n'.format(tag)
+                    yield "tags/{}.html".format(tag), source
+
+            site = Site(base_path=base, items_path=items)
+            site.generate(tag_pages)
+            site.route(r"(.*)", lambda match, item: match.group(1))
+            site.template(r"tags/", lambda item: ", ".join(post.filename for post in item.site.query(where={"tags": item.metadata["tag"]})))
+            self.assertEqual(["a.html", "tags/gnomes.html"], sorted(site.items))
+            self.assertEqual([], calls)
+            self.assertEqual("tags/gnomes.html", site.items["tags/gnomes.html"].file_route)
+            self.assertEqual("a.html", site.items["tags/gnomes.html"].templated)
+
+            # Rules registered after the generator (which scans the site) are applied once
+            def exclaim(item):
+                item.filtered_content += "!"
+            site.filter(r"tags/", exclaim)
+            self.assertEqual([exclaim], site.items["tags/gnomes.html"].filters)
+            lazy = Site(base_path=base, items_path=items)
+            lazy.generate(tag_pages)
+            lazy.filter(r"tags/", exclaim)
+            self.assertEqual([exclaim], lazy.items["tags/gnomes.html"].filters)
+            self.assertEqual("!", lazy.items["tags/gnomes.html"].content)
+
+            with open(os.path.join(items, "b.html"), "w") as file:
+                file.write('---\n{"tags": ["news"]}\n---\nB')
+            changed, removed = site.rescan([os.path.join(items, "b.html")])
+            self.assertEqual(["b.html", "tags/gnomes.html", "tags/news.html"], changed)
+            self.assertEqual("b.html", site.items["tags/news.html"].templated)
+
+            os.remove(os.path.join(items, "a.html"))
+            changed, removed = site.rescan([items])
+            self.assertEqual(["a.html", "tags/gnomes.html"], removed)
+
+            with self.assertRaises(ValueError):
+                site.generate(lambda site: [("b.html", "Conflict!")])
+        finally:
+            shutil.rmtree(base)
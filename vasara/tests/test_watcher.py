@@ -0,0 +1,37 @@
+from unittest import TestCase
+from vasara.watcher import InotifyWatcher, PollingWatcher, create_watcher
+
+import os
+import shutil
+import tempfile
+
+class TestWatcher(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.path, "sub"))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def check_watcher(self, watcher):
+        try:
+            self.assertEqual(set(), watcher.wait(0.01))
+
+            path = os.path.join(self.path, "sub", "test.html")
+            with open(path, "w") as file:
+                file.write("Hello, world!")
+            self.assertIn(path, watcher.changes(debounce=0.05))
+        finally:
+            watcher.close()
+
+    def test_polling(self):
+        """Ensures that the polling watcher detects new files."""
+        self.check_watcher(PollingWatcher(self.path, interval=0.01))
+
+    def test_inotify(self):
+        """Ensures that the inotify watcher detects new files in subdirectories."""
+        watcher = create_watcher(self.path)
+        if not isinstance(watcher, InotifyWatcher):
+            self.skipTest("inotify isn't available")
+        self.check_watcher(watcher)
@@ -0,0 +1,179 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+# inotify event flags, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF)
+
+EVENT = struct.Struct("iIII")
+
+class Watcher(object):
+    """Watches a directory tree for changes. Use :func:`create_watcher` to get the best watcher for
+    the platform."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        """Absolute path to the watched directory."""
+
+    def wait(self, timeout=None):
+        """Waits for changes.
+
+        :param timeout: maximum time to wait in seconds (``None`` waits forever)
+        :returns: set of absolute paths that changed (empty if the timeout expired)"""
+        raise NotImplementedError
+
+    def changes(self, debounce=0.1):
+        """Waits for changes and collects them until no new changes have been seen for ``debounce``
+        seconds, so that bursts of events (for example from a version control checkout) are
+        reported together.
+
+        :param debounce: quiet period in seconds
+        :returns: set of absolute paths that changed"""
+        paths = self.wait()
+        while True:
+            more = self.wait(debounce)
+            if not more:
+                return paths
+            paths |= more
+
+    def close(self):
+        """Stops watching."""
+        pass
+
+class PollingWatcher(Watcher):
+    """Detects changes by periodically comparing the size and modification time of every file."""
+
+    def __init__(self, path, interval=1.0):
+        super(PollingWatcher, self).__init__(path)
+        self.interval = interval
+        """Time between polls in seconds."""
+        self._state = self._snapshot()
+
+    def _snapshot(self):
+        state = {}
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for name in filenames:
+                full = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(full)
+                except OSError:
+                    continue
+                state[full] = (stat.st_size, stat.st_mtime)
+        return state
+
+    def wait(self, timeout=None):
+        start = time.time()
+        while True:
+            state = self._snapshot()
+            paths = set(path for path in set(state) | set(self._state) if state.get(path) != self._state.get(path))
+            self._state = state
+            if paths:
+                return paths
+            if timeout is not None and time.time() - start >= timeout:
+                return set()
+            delay = self.interval
+            if timeout is not None:
+                delay = min(delay, max(0, timeout - (time.time() - start)))
+            time.sleep(delay)
+
+class InotifyWatcher(Watcher):
+    """Watches a directory tree with Linux's inotify API."""
+
+    def __init__(self, path):
+        super(InotifyWatcher, self).__init__(path)
+        self._libc = _libc()
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._directories = {}
+        self._add_tree(self.path)
+
+    def _add_tree(self, path):
+        # inotify isn't recursive, so every directory is watched separately
+        for dirpath, dirnames, filenames in os.walk(path):
+            descriptor = self._libc.inotify_add_watch(self._fd, _encode_path(dirpath), WATCH_MASK)
+            if descriptor >= 0:
+                self._directories[descriptor] = dirpath
+
+    def wait(self, timeout=None):
+        try:
+            readable, _, _ = select.select([self._fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return set()
+            raise
+        if not readable:
+            return set()
+
+        data = os.read(self._fd, 64 * 1024)
+        paths = set()
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            descriptor, mask, cookie, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip("\0")
+            offset += EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: report the whole tree as changed
+                paths.add(self.path)
+                continue
+            if mask & IN_IGNORED:
+                self._directories.pop(descriptor, None)
+                continue
+
+            directory = self._directories.get(descriptor)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            paths.add(path)
+
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path)
+        return paths
+
+    def close(self):
+        os.close(self._fd)
+
+def create_watcher(path, interval=1.0):
+    """Creates an :class:`InotifyWatcher` if inotify is available, and a :class:`PollingWatcher`
+    otherwise.
+
+    :param path: the directory to watch
+    :param interval: polling interval for :class:`PollingWatcher`
+    :returns: :class:`Watcher`"""
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(path, interval=interval)
+
+def _libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.inotify_init.argtypes = []
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+def _encode_path(path):
+    if isinstance(path, unicode):
+        return path.encode(sys.getfilesystemencoding() or "utf-8")
+    return path